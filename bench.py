@@ -0,0 +1,165 @@
+# bench.py — офлайн-бенчмарк эффектов Nature Inspire (Clarity заглушен)
+# Синтетические «фото» фиксированных размеров -> decode -> эффект -> (Clarity-заглушка 2x) -> JPEG под лимит.
+# Каждый кейс — в отдельном процессе (честный пик RSS), время — медиана по повторам.
+#
+#   python bench.py                       # прогон + сравнение с bench_baseline.json
+#   python bench.py --sizes 512 1536      # только часть размеров
+#   python bench.py --update-baseline     # записать текущие цифры как базу
+#
+# Код выхода 1, если время или пик RSS хуже базы больше чем на --max-regression.
+
+import os, sys, io, json, time, argparse, resource, platform, statistics
+import multiprocessing as mp
+
+os.environ.setdefault("TELEGRAM_API_TOKEN", "0:bench")   # bot.py требует токен при импорте
+os.environ.pop("REPLICATE_API_TOKEN", None)               # никакого сетевого Clarity
+
+HERE          = os.path.dirname(os.path.abspath(__file__))
+BASELINE_PATH = os.path.join(HERE, "bench_baseline.json")
+RESULTS_PATH  = os.path.join(HERE, "bench_results.json")
+
+SIZES   = (512, 1536, 2560, 4096)   # 2560 — полное фото из Telegram
+EFFECTS = (("ne2", 0.0), ("wow", 0.01), ("wow", 0.50), ("wow", 1.00), ("violin_boost", 0.0), ("violin_boost2", 0.0))
+
+def synth_photo(side: int, seed: int = 1337) -> bytes:
+    """Детерминированное «фото» 4:3: плавный свет, цветные пятна, тёплые (кожа) зоны, мелкая текстура."""
+    import numpy as np
+    from PIL import Image
+    rng  = np.random.default_rng(seed)
+    h, w = side * 3 // 4, side
+    yy, xx = np.mgrid[0:h, 0:w].astype(np.float32)
+    yy /= h; xx /= w
+    sky  = np.stack([0.35 + 0.3*yy, 0.5 + 0.2*yy, 0.85 - 0.3*yy], -1)
+    img  = sky * (0.6 + 0.4*np.cos(3.1*xx)[..., None])
+    for _ in range(12):
+        cy, cx, r = rng.random(), rng.random(), 0.05 + 0.2*rng.random()
+        col  = rng.random(3).astype(np.float32)
+        blob = np.exp(-(((yy - cy)**2 + (xx - cx)**2) / (r*r)))[..., None]
+        img  = img*(1 - 0.7*blob) + col*0.7*blob
+    skin = np.exp(-(((yy - 0.6)**2 + (xx - 0.3)**2) / 0.01))[..., None]
+    img  = img*(1 - skin) + np.array([0.85, 0.62, 0.48], np.float32)*skin
+    img += rng.normal(0, 0.03, img.shape).astype(np.float32)
+    u8   = (np.clip(img, 0, 1)*255).astype(np.uint8)
+    buf  = io.BytesIO()
+    Image.fromarray(u8).save(buf, "JPEG", quality=92)
+    return buf.getvalue()
+
+def _clarity_stub(im, max_side: int):
+    """Вместо Replicate: такой же размер выхода (вход ужат до CLARITY_INPUT_MAX_SIDE, scale_factor 2)."""
+    from PIL import Image
+    scale = 2 * min(1.0, max_side / max(im.size))
+    return im.resize((round(im.size[0]*scale), round(im.size[1]*scale)), Image.LANCZOS)
+
+def run_case(data: bytes, effect: str, ui_gain: float, repeats: int) -> dict:
+    """Выполняется в отдельном процессе; фото генерирует родитель, чтобы генератор не попал в пик RSS."""
+    import bot
+    stages = {"decode": [], "effect": [], "clarity_stub": [], "encode": [], "total": []}
+    out_kb = quality = encodes = None
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        im = bot.load_input(data, bot.INPUT_MAX_SIDE)
+        t1 = time.perf_counter()
+        if effect == "ne2":             im = bot.hdr_only(im)
+        elif effect == "violin_boost":  im = bot.violin_touch_v1(im)
+        elif effect == "violin_boost2": im = bot.violin_touch_v2(im)
+        else:                           im = bot.wow_enhance(im, ui_gain)
+        t2 = time.perf_counter()
+        if effect in bot.CLARITY_CFG:
+            im = _clarity_stub(im, bot.CLARITY_INPUT_MAX_SIDE)
+        t3 = time.perf_counter()
+        out, quality, encodes = bot.ensure_size_under_telegram_limit(im)
+        t4 = time.perf_counter()
+        for k, v in zip(stages, (t1-t0, t2-t1, t3-t2, t4-t3, t4-t0)):
+            stages[k].append(v)
+        out_kb = len(out) >> 10
+    return {
+        "ms":          {k: round(statistics.median(v)*1e3, 1) for k, v in stages.items()},
+        "peak_rss_mb": round(peak_rss_kb() / 1024, 1),
+        "out_kb":      out_kb,
+        "quality":     quality,
+        "encodes":     encodes,
+    }
+
+def peak_rss_kb() -> int:
+    """
+    Пик RSS процесса. VmHWM, а не ru_maxrss: ru_maxrss переживает fork+exec и тянет пик родителя
+    (а родитель только что сгенерировал 4096px фото).
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def case_name(side: int, effect: str, ui_gain: float) -> str:
+    return f"{effect}@{ui_gain:g}/{side}" if effect == "wow" else f"{effect}/{side}"
+
+def run_all(sizes, repeats: int) -> dict:
+    ctx = mp.get_context("spawn")
+    results = {}
+    for side in sizes:
+        data = synth_photo(side)
+        for effect, gain in EFFECTS:
+            with ctx.Pool(1) as pool:
+                r = pool.apply(run_case, (data, effect, gain, repeats))
+            name = case_name(side, effect, gain)
+            results[name] = r
+            print(f"{name:<22} total {r['ms']['total']:>8.1f} ms  effect {r['ms']['effect']:>8.1f} ms  "
+                  f"encode {r['ms']['encode']:>7.1f} ms  rss {r['peak_rss_mb']:>7.1f} MB  "
+                  f"out {r['out_kb']} KB q{r['quality']} x{r['encodes']}", flush=True)
+    return results
+
+def compare(results: dict, baseline: dict, max_regression: float) -> list:
+    """-> список регрессий (время total и пик RSS)."""
+    bad = []
+    for name, r in results.items():
+        b = baseline.get(name)
+        if not b:
+            continue
+        for label, cur, ref in (("total ms", r["ms"]["total"], b["ms"]["total"]),
+                                ("peak RSS MB", r["peak_rss_mb"], b["peak_rss_mb"])):
+            if ref and cur > ref * (1.0 + max_regression):
+                bad.append(f"{name}: {label} {cur} > {ref} (+{(cur/ref - 1)*100:.0f}%)")
+    return bad
+
+def main():
+    ap = argparse.ArgumentParser(description="Nature Inspire effect benchmark (Clarity stubbed)")
+    ap.add_argument("--sizes", type=int, nargs="+", default=list(SIZES))
+    ap.add_argument("--repeats", type=int, default=3)
+    ap.add_argument("--out", default=RESULTS_PATH)
+    ap.add_argument("--baseline", default=BASELINE_PATH)
+    ap.add_argument("--max-regression", type=float, default=0.25, help="доля, напр. 0.25 = +25%%")
+    ap.add_argument("--update-baseline", action="store_true")
+    args = ap.parse_args()
+
+    results = run_all(args.sizes, args.repeats)
+    doc = {
+        "meta": {"python": platform.python_version(), "machine": platform.machine(),
+                 "cpus": os.cpu_count(), "repeats": args.repeats, "time": int(time.time())},
+        "results": results,
+    }
+    with open(args.out, "w") as f:
+        json.dump(doc, f, indent=1, sort_keys=True)
+    print(f">> results: {args.out}")
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(doc, f, indent=1, sort_keys=True)
+        print(f">> baseline updated: {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(">> no baseline yet (run with --update-baseline)")
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)["results"]
+    bad = compare(results, baseline, args.max_regression)
+    for line in bad:
+        print("REGRESSION", line)
+    print(">> OK" if not bad else f">> {len(bad)} regression(s)")
+    return 1 if bad else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
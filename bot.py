@@ -1,36 +1,110 @@
 # bot.py — Nature Inspire (фикс микса): HDR-only = Nature Enhance 2.0, WOW = сочный топ-пайплайн
 # + 🎻 Violin Touch: оставлено "Усиление 🎻" + добавлено "Усиление 2 🎻"
 # Clarity используется ТОЛЬКО в WOW, "Violin Усиление", "Violin Усиление 2"
-# env: TELEGRAM_API_TOKEN, REPLICATE_API_TOKEN (опц., для Clarity)
-
-import os, logging, tempfile, urllib.request, traceback
+# env: TELEGRAM_API_TOKEN, REPLICATE_API_TOKEN (опц., для Clarity), WEBHOOK_URL (опц., иначе long polling)
+
+import os, io, abc, logging, asyncio, contextlib, contextvars, time, base64, functools, hashlib, hmac, json, signal, sqlite3, threading
+from collections import deque, OrderedDict
+import aiohttp
+from aiohttp import web
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import numpy as np
-from PIL import Image, ImageFilter, ImageOps, ImageEnhance, ImageChops
+import cv2
+from PIL import Image, ImageOps
 from aiogram import Bot, Dispatcher, types
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InputFile
 from aiogram.utils import executor
-
-# --- опц. для Clarity ---
-try:
-    import replicate
-except Exception:
-    replicate = None
+from aiogram.utils.exceptions import TelegramAPIError
 
 logging.basicConfig(level=logging.INFO)
 
 # ---------- TOKENS ----------
 API_TOKEN  = os.getenv("TELEGRAM_API_TOKEN")
 if not API_TOKEN:  raise RuntimeError("TELEGRAM_API_TOKEN missing")
-REPL_TOKEN = os.getenv("REPLICATE_API_TOKEN")  # может быть None
-if REPL_TOKEN and replicate:
-    os.environ["REPLICATE_API_TOKEN"] = REPL_TOKEN
+REPL_TOKEN = os.getenv("REPLICATE_API_TOKEN")  # может быть None -> Clarity выключен
 
 bot = Bot(token=API_TOKEN)
 dp  = Dispatcher(bot)
 
 # ---------- TUNABLES ----------
-INPUT_MAX_SIDE       = 1536
-FINAL_TELEGRAM_LIMIT = 10 * 1024 * 1024
+# Эффекты идут по тайлам, поэтому вход можно брать в полном размере (фото из Telegram — до 2560 px);
+# Clarity получает копию не больше CLARITY_INPUT_MAX_SIDE (время и цена prediction'а растут с площадью)
+INPUT_MAX_SIDE         = int(os.getenv("INPUT_MAX_SIDE", "4096"))
+CLARITY_INPUT_MAX_SIDE = int(os.getenv("CLARITY_INPUT_MAX_SIDE", "1536"))
+FINAL_TELEGRAM_LIMIT   = 10 * 1024 * 1024
+
+# Тайлы: кадр больше TILE_MAX_PX режем на TILE_SIDE x TILE_SIDE (+ ореол под радиусы блюров),
+# рабочие float-буферы эффекта — размером с тайл, а не с кадр. Полное фото из Telegram (2560x1920)
+# идёт одним куском: тайлы считают первый проход дважды, на типичном размере это дороже памяти
+TILE_SIDE   = int(os.getenv("TILE_SIDE", "1024"))        # кратно 64
+TILE_MAX_PX = int(os.getenv("TILE_MAX_PX", str(2560 * 1920)))
+
+# Подгонка JPEG под лимит: качество предсказываем по пробному энкоду мозаики из тайлов,
+# дальше не больше JPEG_MAX_ENCODES полных энкодов; ниже JPEG_Q_FLOOR — уменьшаем картинку
+JPEG_Q_MAX       = 95
+JPEG_Q_FLOOR     = 60
+JPEG_MAX_ENCODES = 3
+JPEG_PROBE_PX    = 512 * 512
+
+# Кэш готовых результатов: память (LRU) + диск с потолком; CACHE_VERSION поднимать при смене пайплайна
+CACHE_VERSION     = 2
+CACHE_MEM_MAX_MB  = int(os.getenv("CACHE_MEM_MAX_MB", "64"))
+CACHE_DISK_MAX_MB = int(os.getenv("CACHE_DISK_MAX_MB", "512"))
+CACHE_DIR         = os.getenv("CACHE_DIR", "/tmp/nature_inspire_cache")   # пусто -> только память
+
+# Состояние диалога (выбранный режим): SESSION_DB пусто -> память процесса, иначе SQLite-файл,
+# общий для нескольких процессов на хосте. Брошенный выбор живёт SESSION_TTL_S
+SESSION_DB     = os.getenv("SESSION_DB", "")
+SESSION_TTL_S  = float(os.getenv("SESSION_TTL_S", str(6 * 3600)))
+SESSION_MAX    = int(os.getenv("SESSION_MAX", "50000"))   # только для памяти: сверх — вытесняем самые старые
+
+# Альбом (media group) собираем, пока приходят его фото: ждём ALBUM_WAIT_S тишины
+ALBUM_WAIT_S   = float(os.getenv("ALBUM_WAIT_S", "1.0"))
+
+# Пул процессов под эффекты: 0 = по числу ядер; сверх workers ждут не больше POOL_QUEUE_MAX задач
+POOL_WORKERS   = int(os.getenv("POOL_WORKERS", "0")) or (os.cpu_count() or 1)
+POOL_QUEUE_MAX = int(os.getenv("POOL_QUEUE_MAX", "16"))
+
+# HTTP-скачивания (через общий aiohttp-пул бота): таймаут, чанк, потолки размера
+HTTP_TIMEOUT_S    = float(os.getenv("HTTP_TIMEOUT_S", "60"))
+HTTP_CHUNK        = 64 * 1024
+TG_DOWNLOAD_MAX   = 20 * 1024 * 1024   # Bot API всё равно не отдаёт файлы больше 20 МБ
+CLARITY_FETCH_MAX = 64 * 1024 * 1024
+
+# Clarity через HTTP API Replicate: лимит одновременных prediction'ов, дедлайн задачи, поллинг
+REPLICATE_API_BASE   = os.getenv("REPLICATE_API_BASE", "https://api.replicate.com").rstrip("/")
+CLARITY_MAX_INFLIGHT = int(os.getenv("CLARITY_MAX_INFLIGHT", "4"))
+CLARITY_DEADLINE_S   = float(os.getenv("CLARITY_DEADLINE_S", "240"))
+CLARITY_POLL_MIN_S   = 0.5
+CLARITY_POLL_MAX_S   = 3.0
+# Бюджет Clarity по эффекту, с (очередь + prediction, не больше CLARITY_DEADLINE_S); не уложились — локальный апскейл.
+# Если после очереди на prediction остаётся меньше CLARITY_MIN_RUN_S — в Replicate даже не идём.
+CLARITY_BUDGET_S  = {"wow": 120.0, "violin_boost": 120.0, "violin_boost2": 150.0}
+CLARITY_MIN_RUN_S = float(os.getenv("CLARITY_MIN_RUN_S", "15"))
+# Предохранитель: CLARITY_BREAKER_FAILS неудач подряд (ошибка/таймаут) — Clarity не зовём COOLDOWN секунд,
+# потом пускаем одну пробу; проба упала — пауза удваивается (до COOLDOWN_MAX), удалась — всё как обычно
+CLARITY_BREAKER_FAILS        = int(os.getenv("CLARITY_BREAKER_FAILS", "5"))
+CLARITY_BREAKER_COOLDOWN_S   = float(os.getenv("CLARITY_BREAKER_COOLDOWN_S", "60"))
+CLARITY_BREAKER_COOLDOWN_MAX_S = float(os.getenv("CLARITY_BREAKER_COOLDOWN_MAX_S", "600"))
+
+# Честность между пользователями: воркеры и Clarity раздаются round-robin по пользователям,
+# локальный ne2 — вне очереди WOW/Violin. Потолки на пользователя (0 = без потолка) и лимит частоты:
+# USER_RATE_PER_MIN фото в минуту в среднем, пачкой (альбом) — до USER_RATE_BURST
+USER_POOL_MAX     = int(os.getenv("USER_POOL_MAX", "0"))
+USER_CLARITY_MAX  = int(os.getenv("USER_CLARITY_MAX", "2"))   # альбом веером, но половина слотов — другим
+USER_RATE_PER_MIN = float(os.getenv("USER_RATE_PER_MIN", "12"))
+USER_RATE_BURST   = int(os.getenv("USER_RATE_BURST", "10"))
+
+# Метрики (Prometheus text) на встроенном HTTP-сервере; порт тот же, что EXPOSE в Dockerfile
+HTTP_PORT = int(os.getenv("PORT", "8080"))
+
+# Webhook вместо long polling: включается, если задан WEBHOOK_URL (публичный https-адрес без пути).
+# Секрет общий для всех реплик; по умолчанию выводится из токена бота. Telegram допускает [A-Za-z0-9_-]{1,256}
+WEBHOOK_URL     = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH    = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_SECRET  = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(f"webhook:{API_TOKEN}".encode()).hexdigest()
+WEBHOOK_DRAIN_S = float(os.getenv("WEBHOOK_DRAIN_S", "60"))   # сколько ждём начатые апдейты при остановке
 
 # UI уровни (мягкий множитель для всех компонент; сами компоненты крутятся отдельно ниже)
 UI_LOW, UI_MED, UI_HIGH = 0.01, 0.50, 1.00
@@ -88,55 +162,278 @@ CL_V2 = dict(
     lora_more_details = 0.58,   # + чуть «детальности»
     lora_render = 1.30,         # + чуть «жира»
 )
+
+# Замена Clarity, пока он недоступен: Lanczos x scale_factor + лёгкий unsharp (размер выхода — как у Clarity)
+FALLBACK_SHARPEN = dict(radius=1.2, percent=60, threshold=2)
+
+# Какой Clarity у какого эффекта (ne2 — без Clarity)
+CLARITY_CFG = {
+    "wow":           CL_BASE,   # WOW на базовом clarity
+    "violin_boost":  CL_BASE,   # Clarity v1
+    "violin_boost2": CL_V2,     # Clarity v2 (чуть сильнее)
+}
+PREVIEW_CAPTION = "👀 Превью. Докручиваю детали (Clarity) — заменю это фото, как будет готово."
 # ================================================================================
 
 # ---------- STATE ----------
 # user_id -> {'effect': 'ne2' | 'wow_menu' | 'wow' | 'violin_menu' | 'violin_boost' | 'violin_boost2', 'ui_gain': float}
-WAIT = {}
+class SessionStore(abc.ABC):
+    """
+    Интерфейс хранилища состояния: каждая операция атомарна; протухшие записи не возвращаются.
+    Бэкенд без get/set/pop не создастся вовсе (TypeError при конструировании, а не на первом фото).
+    """
+    @abc.abstractmethod
+    async def get(self, uid: int): ...
 
-# ---------- HELPERS ----------
-def resize_inplace(path: str, max_side: int):
-    try:
-        im = Image.open(path)
-        im = ImageOps.exif_transpose(im).convert("RGB")
-        if max(im.size) > max_side:
-            im.thumbnail((max_side, max_side), Image.LANCZOS)
-        im.save(path, "JPEG", quality=95, optimize=True)
-    except Exception:
+    @abc.abstractmethod
+    async def set(self, uid: int, st: dict): ...
+
+    @abc.abstractmethod
+    async def pop(self, uid: int): ...
+
+    def close(self):
         pass
 
-def ensure_size_under_telegram_limit(path: str, max_bytes: int = FINAL_TELEGRAM_LIMIT) -> str:
-    try:
-        if os.path.getsize(path) <= max_bytes: return path
-        img = Image.open(path).convert("RGB")
-        q = 92
-        for _ in range(10):
-            fd, tmp = tempfile.mkstemp(suffix=".jpg"); os.close(fd)
-            img.save(tmp, "JPEG", quality=q, optimize=True)
-            if os.path.getsize(tmp) <= max_bytes:
-                os.remove(path); return tmp
-            os.remove(tmp); q -= 8
-        fd, tmp = tempfile.mkstemp(suffix=".jpg"); os.close(fd)
-        img.save(tmp, "JPEG", quality=max(q, 40), optimize=True)
-        os.remove(path); return tmp
-    except Exception:
-        return path
+class MemorySessionStore(SessionStore):
+    """Память процесса: TTL + потолок по числу записей. Порядок вставки = порядок протухания (TTL общий)."""
+    def __init__(self, ttl_s: float, max_size: int):
+        self.ttl_s, self.max_size = ttl_s, max_size
+        self._d = OrderedDict()   # uid -> (expires, st)
+
+    def _expire(self, now: float):
+        while self._d:
+            uid, (exp, _) = next(iter(self._d.items()))
+            if exp > now and len(self._d) <= self.max_size: break
+            del self._d[uid]
+
+    async def get(self, uid: int):
+        item = self._d.get(uid)
+        if item is None or item[0] <= time.monotonic():
+            return None
+        return dict(item[1])
+
+    async def set(self, uid: int, st: dict):
+        self._d.pop(uid, None)
+        self._d[uid] = (time.monotonic() + self.ttl_s, dict(st))
+        self._expire(time.monotonic())
+
+    async def pop(self, uid: int):
+        item = self._d.pop(uid, None)
+        return dict(item[1]) if item and item[0] > time.monotonic() else None
+
+    def __len__(self):
+        return len(self._d)
+
+class SqliteSessionStore(SessionStore):
+    """
+    SQLite (WAL): переживает рестарт и общий для процессов на одном хосте. Запросы — в потоке,
+    не на event loop; протухшие строки чистим попутно раз в SWEEP_EVERY записей.
+    """
+    SWEEP_EVERY = 256
+
+    def __init__(self, path: str, ttl_s: float):
+        self.ttl_s = ttl_s
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS sessions (uid INTEGER PRIMARY KEY, st TEXT NOT NULL, expires REAL NOT NULL)")
+        self._lock   = threading.Lock()
+        self._writes = 0
+
+    def _q(self, sql: str, args: tuple = ()):
+        with self._lock:
+            return self._db.execute(sql, args).fetchone()
+
+    def _set(self, uid: int, st: dict):
+        now = time.time()
+        self._q("INSERT OR REPLACE INTO sessions (uid, st, expires) VALUES (?, ?, ?)", (uid, json.dumps(st), now + self.ttl_s))
+        self._writes += 1
+        if self._writes % self.SWEEP_EVERY == 0:
+            self._q("DELETE FROM sessions WHERE expires <= ?", (now,))
+
+    async def get(self, uid: int):
+        row = await asyncio.to_thread(self._q, "SELECT st FROM sessions WHERE uid = ? AND expires > ?", (uid, time.time()))
+        return json.loads(row[0]) if row else None
+
+    async def set(self, uid: int, st: dict):
+        await asyncio.to_thread(self._set, uid, st)
+
+    async def pop(self, uid: int):
+        # DELETE ... RETURNING — чтение и удаление одним стейтментом, без гонки между процессами
+        row = await asyncio.to_thread(self._q, "DELETE FROM sessions WHERE uid = ? RETURNING st, expires", (uid,))
+        return json.loads(row[0]) if row and row[1] > time.time() else None
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+SESSIONS = SqliteSessionStore(SESSION_DB, SESSION_TTL_S) if SESSION_DB else MemorySessionStore(SESSION_TTL_S, SESSION_MAX)
+
+# ---------- HELPERS ----------
+def load_input(data: bytes, max_side: int) -> np.ndarray:
+    """
+    Вход эффекта -> uint8 HxWx3. JPEG декодируется сразу близко к max_side (DCT-масштабирование
+    1/2..1/8 через draft, не меньше цели), добивается LANCZOS, ориентация из EXIF — один раз,
+    уже на маленьком кадре. Image дальше не живёт — эффект получает готовый массив.
+    """
+    im = Image.open(io.BytesIO(data))
+    w, h = im.size   # как лежит в файле; рамка max_side квадратная, так что поворот тут не важен
+    k = max_side / max(w, h)
+    if k < 1.0:
+        im.draft("RGB", (max(1, int(w*k)), max(1, int(h*k))))
+        im.thumbnail((max_side, max_side), Image.LANCZOS)
+    ImageOps.exif_transpose(im, in_place=True)
+    if im.mode != "RGB":
+        im = im.convert("RGB")
+    return np.asarray(im)
+
+def pick_photo(sizes: list, max_side: int):
+    """Самый маленький PhotoSize, которого хватает на max_side (меньше качать и декодировать); иначе самый большой."""
+    sizes = sorted(sizes, key=lambda p: p.width * p.height)
+    return next((p for p in sizes if max(p.width, p.height) >= max_side), sizes[-1])
+
+def clarity_input(im: Image.Image, max_side: int = None) -> bytes:
+    """JPEG для Replicate: кадр, ужатый до max_side (Clarity всё равно апскейлит x2)."""
+    max_side = max_side or CLARITY_INPUT_MAX_SIDE
+    if max(im.size) > max_side:
+        im = im.copy(); im.thumbnail((max_side, max_side), Image.LANCZOS)
+    return encode_jpeg(im, 95)
+
+def decode_image(data: bytes) -> Image.Image:
+    return Image.open(io.BytesIO(data)).convert("RGB")
+
+def encode_jpeg(im: Image.Image, quality: int = 95) -> bytes:
+    buf = io.BytesIO()
+    im.save(buf, "JPEG", quality=quality, optimize=True)
+    return buf.getvalue()
+
+_PROBE_Q = (95, 88, 80, 70, 60, 45)
+
+def _jpeg_probe(im: Image.Image) -> list:
+    """
+    Пробный энкод мозаики из тайлов 32x32 (~JPEG_PROBE_PX), собранных сеткой по всему кадру:
+    в отличие от даунскейла сохраняет детальность на пиксель. -> [(q, байт на пиксель), ...].
+    """
+    T = 32
+    arr = np.asarray(im)
+    h, w = arr.shape[:2]
+    n  = max(1, int((JPEG_PROBE_PX / (T*T)) ** 0.5))
+    ys = np.linspace(0, max(h - T, 0), min(n, max(h // T, 1))).astype(np.intp)
+    xs = np.linspace(0, max(w - T, 0), min(n, max(w // T, 1))).astype(np.intp)
+    rows = (ys[:, None] + np.arange(min(T, h))).ravel()
+    cols = (xs[:, None] + np.arange(min(T, w))).ravel()
+    mosaic = Image.fromarray(np.ascontiguousarray(arr[rows][:, cols]))
+    px = mosaic.size[0] * mosaic.size[1]
+    return [(q, len(encode_jpeg(mosaic, q)) / px) for q in _PROBE_Q]
+
+def _predict_quality(curve: list, pixels: int, budget: float) -> int:
+    """Максимальное качество, при котором предсказанный размер <= budget (лог-интерполяция по пробам)."""
+    est = lambda bpp: bpp * pixels
+    if est(curve[0][1]) <= budget:
+        return curve[0][0]
+    for (q1, b1), (q2, b2) in zip(curve, curve[1:]):
+        if est(b2) <= budget:
+            t = (np.log(est(b1)) - np.log(budget)) / max(np.log(b1) - np.log(b2), 1e-9)
+            return int(q1 - t*(q1 - q2))
+    return curve[-1][0] - 1   # даже низшая проба не влезла
+
+def ensure_size_under_telegram_limit(im: Image.Image, max_bytes: int = FINAL_TELEGRAM_LIMIT) -> tuple:
+    """
+    Финальный (и обычно единственный) JPEG-энкод под лимит Telegram, всё в памяти.
+    Небольшие кадры — сразу q95; крупные — качество по пробе, поправка модели по факту каждого энкода,
+    не больше JPEG_MAX_ENCODES полных энкодов; если и JPEG_Q_FLOOR не влезает — до двух попыток
+    с уменьшением (плюс запасной гарантированный масштаб). Возвращает (jpeg_bytes, quality, encodes).
+    """
+    pixels  = im.size[0] * im.size[1]
+    encodes = 0
+    first   = None
+    if pixels * 1.2 <= max_bytes:          # q95 почти не бывает больше ~1 байта на пиксель
+        first = encode_jpeg(im, JPEG_Q_MAX); encodes = 1
+        if len(first) <= max_bytes:
+            return first, JPEG_Q_MAX, encodes
+
+    curve  = _jpeg_probe(im)
+    bpp_at = lambda q: float(np.interp(-q, [-c[0] for c in curve], [c[1] for c in curve]))
+    budget = max_bytes * 0.97
+    corr   = 1.0 if first is None else len(first) / (bpp_at(JPEG_Q_MAX) * pixels)
+    best   = None
+    lo, hi = 0, (JPEG_Q_MAX if first is not None else JPEG_Q_MAX + 1)   # лучшее влезшее / худшее не влезшее
+
+    while encodes < JPEG_MAX_ENCODES:
+        q = max(min(_predict_quality(curve, pixels * corr, budget), hi - 1), lo + 1)
+        if q < JPEG_Q_FLOOR or q >= hi:
+            break
+        data = encode_jpeg(im, q); encodes += 1
+        corr = len(data) / (bpp_at(q) * pixels)
+        if len(data) <= max_bytes:
+            best, lo = (data, q), q
+            if len(data) >= budget * 0.85 or q >= hi - 1:
+                break
+        else:
+            hi = q
+
+    if best:
+        return best[0], best[1], encodes
+
+    # качество упёрлось бы в пол — уменьшаем кадр и жмём на JPEG_Q_FLOOR. Первый масштаб — по модели с поправкой
+    # corr от прошлых энкодов; размер от масштаба растёт быстрее площади (даунскейл съедает мелкие детали),
+    # поэтому вторая попытка — по степенной кривой через факт первой и модельный полный кадр
+    full  = bpp_at(JPEG_Q_FLOOR) * corr * pixels
+    scale = min(0.95, (budget / full) ** 0.5)
+    fit   = None
+    for _ in range(2):
+        data = encode_jpeg(_downscale(im, scale), JPEG_Q_FLOOR); encodes += 1
+        if len(data) <= max_bytes:
+            if fit is None or len(data) > len(fit[0]):
+                fit = (data, scale)
+            if len(data) >= budget * 0.85:
+                break
+        elif fit:
+            break   # перелёт после недолёта — берём недолёт
+        k     = min(4.0, max(1.0, np.log(full / len(data)) / -np.log(scale))) if full > len(data) else 2.0
+        scale = min(0.95, scale * (budget * 0.95 / len(data)) ** (1.0 / k))
+    if fit is None:
+        # запасной масштаб с гарантией: больше 3 байт на пиксель (RGB без сжатия) JPEG не бывает
+        scale = min(0.95, (max_bytes * 0.9 / (3 * pixels)) ** 0.5)
+        fit   = (encode_jpeg(_downscale(im, scale), JPEG_Q_FLOOR), scale); encodes += 1
+    logging.info("jpeg fit: downscaled %.2fx to fit %d bytes", fit[1], max_bytes)
+    return fit[0], JPEG_Q_FLOOR, encodes
+
+def _downscale(im: Image.Image, scale: float) -> Image.Image:
+    return im.resize((max(1, int(im.size[0]*scale)), max(1, int(im.size[1]*scale))), Image.LANCZOS)
 
 def tg_url(file_path: str) -> str:
     return f"https://api.telegram.org/file/bot{API_TOKEN}/{file_path}"
 
-async def download_tg_photo(file_id: str) -> str:
+class DownloadTooLarge(Exception):
+    pass
+
+class HttpStatusError(aiohttp.ClientError):
+    """HTTP-ошибка скачивания: только код, без URL (в URL файлов Telegram — токен бота)."""
+    def __init__(self, status: int):
+        super().__init__(f"HTTP {status}")
+        self.status = status
+
+async def http_fetch(url: str, max_bytes: int) -> bytes:
+    """Потоковое скачивание в память через keep-alive сессию бота (с потолком max_bytes)."""
+    session = await bot.get_session()
+    timeout = aiohttp.ClientTimeout(total=HTTP_TIMEOUT_S, sock_connect=10)
+    async with session.get(url, timeout=timeout) as r:
+        if r.status >= 400:
+            raise HttpStatusError(r.status)
+        if r.content_length and r.content_length > max_bytes:
+            raise DownloadTooLarge(f"{r.content_length} > {max_bytes}")
+        buf = bytearray()
+        async for chunk in r.content.iter_chunked(HTTP_CHUNK):
+            buf.extend(chunk)
+            if len(buf) > max_bytes:
+                raise DownloadTooLarge(f"> {max_bytes}")
+    return bytes(buf)
+
+async def download_tg_photo(file_id: str) -> bytes:
     tg_file = await bot.get_file(file_id)
-    url = tg_url(tg_file.file_path)
-    fd, path = tempfile.mkstemp(suffix=".jpg"); os.close(fd)
-    urllib.request.urlretrieve(url, path)
-    resize_inplace(path, INPUT_MAX_SIDE)
-    return path
-
-def download_to_temp(url: str, suffix=".jpg") -> str:
-    fd, path = tempfile.mkstemp(suffix=suffix); os.close(fd)
-    urllib.request.urlretrieve(url, path)
-    return path
+    return await http_fetch(tg_url(tg_file.file_path), TG_DOWNLOAD_MAX)
 
 def _pick_first_url(x):
     try:
@@ -149,184 +446,926 @@ def _pick_first_url(x):
     except:
         return str(x)
 
-# ---------- CORE OPS ----------
-def _vibrance(arr: np.ndarray, gain: float) -> np.ndarray:
-    mx = arr.max(axis=-1, keepdims=True)
-    mn = arr.min(axis=-1, keepdims=True)
-    sat = mx - mn
-    w   = 1.0 - sat
-    mean = arr.mean(axis=-1, keepdims=True)
-    out  = mean + (arr - mean) * (1.0 + gain * w)
-    return np.clip(out, 0.0, 1.0)
+# ---------- CORE OPS (fused tone engine) ----------
+# HDR-лог, S-кривая и вибранс идут одним проходом по полосам в TONE_BAND_ROWS строк:
+# рабочие буферы размером с полосу (живут в кэше CPU), сам кадр меняется in-place.
+LUMA_W         = (0.2627, 0.6780, 0.0593)   # BT.2020 — по ней HDR-кривая
+PIL_L_W        = (0.299, 0.587, 0.114)      # так PIL считает L (среднее для Contrast)
+TONE_LUT_N     = 4096
+TONE_BAND_ROWS = 64
+
+# Violin: вибранс с защитой кожи; маску можно считать на уменьшенной копии + растушевать
+# (SKIN_MASK_SCALE<1 в тайлах — своя сетка уменьшения у каждого тайла: край маски чуть отличается от полнокадрового)
+VIOLIN_VIBRANCE   = 0.48
+SKIN_MASK_SCALE   = float(os.getenv("SKIN_MASK_SCALE", "1.0"))
+SKIN_MASK_FEATHER = float(os.getenv("SKIN_MASK_FEATHER", "0"))
+
+@functools.lru_cache(maxsize=64)
+def _hdr_ratio_lut(A: float) -> np.ndarray:
+    """Квантованная лума -> y/luma для лог-кривой log1p(A*l)/log1p(A)."""
+    l = np.maximum(np.linspace(0.0, 1.0, TONE_LUT_N), 1e-6)
+    y = np.log1p(A*l) / (np.log1p(A)+1e-8)
+    return (y / l).astype(np.float32)
 
-def _s_curve(x: np.ndarray, amt: float) -> np.ndarray:
-    return np.clip(x*(1-amt) + (3*x*x - 2*x*x*x)*amt, 0.0, 1.0)
+def _to_float(im: Image.Image) -> np.ndarray:
+    src = np.asarray(im)
+    arr = np.empty(src.shape, np.float32)
+    np.multiply(src, np.float32(1/255), out=arr)
+    return arr
+
+def _to_u8(arr: np.ndarray) -> np.ndarray:
+    """float [0..1] -> uint8 HxWx3; arr портится (масштабируем in-place)."""
+    np.multiply(arr, 255, out=arr)
+    return arr.astype(np.uint8)
+
+def tone_core(arr: np.ndarray, hdr_a: float, s_amt: float = 0.0, vib_gain: float = 0.0) -> float:
+    """
+    In-place: HDR-лог по луме (через LUT) -> S-кривая -> вибранс, всё с клипом в [0..1].
+    Возвращает среднюю луму входа (для анти-серости).
+    """
+    h, w = arr.shape[:2]
+    bh   = min(h, TONE_BAND_ROWS)
+    L    = np.empty((bh, w), np.float32)
+    T    = np.empty((bh, w), np.float32)
+    M    = np.empty((bh, w), np.float32)
+    I    = np.empty((bh, w), np.int32)
+    S    = np.empty((bh, w, 3), np.float32)
+    lut  = _hdr_ratio_lut(float(hdr_a))
+    c0, c1, c2 = 1.0 - s_amt, 3.0*s_amt, -2.0*s_amt
+    luma_sum = 0.0
+
+    for y0 in range(0, h, bh):
+        a = arr[y0:y0+bh]; n = a.shape[0]
+        l, t, mx, idx, sc = L[:n], T[:n], M[:n], I[:n], S[:n]
+
+        # HDR: ratio(l) из LUT, l квантуем прямо в буфере
+        np.multiply(a[...,0], LUMA_W[0], out=l)
+        np.multiply(a[...,1], LUMA_W[1], out=t); l += t
+        np.multiply(a[...,2], LUMA_W[2], out=t); l += t
+        luma_sum += float(l.sum(dtype=np.float64))
+        np.multiply(l, TONE_LUT_N - 1, out=l); l += 0.5
+        np.copyto(idx, l, casting="unsafe")
+        np.take(lut, idx, out=t, mode="clip")
+        a *= t[...,None]
+        np.clip(a, 0.0, 1.0, out=a)
+
+        # S-кривая по Горнеру: x*(c0 + x*(c1 + c2*x)); на [0..1] остаётся в [0..1]
+        if s_amt:
+            np.multiply(a, c2, out=sc); sc += c1; sc *= a; sc += c0
+            a *= sc
+
+        if vib_gain:
+            _vibrance_band(a, vib_gain, mx, t)
+
+    return luma_sum / float(h * w)
+
+def _vibrance_band(a: np.ndarray, gain: float, mx: np.ndarray, t: np.ndarray, keep: np.ndarray = None):
+    """
+    Вибранс in-place: mean + (x-mean)*(1 + gain*(1-sat)*(1-keep)); keep — маска защиты (1 = не трогать).
+    mx, t — скретч-плоскости размером с полосу. max/min/mean по каналам — через view'ы:
+    reduce по оси из 3 элементов в numpy очень медленный.
+    """
+    r, g, b = a[...,0], a[...,1], a[...,2]
+    np.maximum(r, g, out=mx); np.maximum(mx, b, out=mx)
+    np.minimum(r, g, out=t);  np.minimum(t, b, out=t)
+    mx -= t
+    np.multiply(mx, -gain, out=mx); mx += gain            # gain*(1-sat)
+    if keep is not None:
+        np.multiply(keep, mx, out=t); mx -= t
+    mx += 1.0
+    np.add(r, g, out=t); t += b; t *= np.float32(1/3)
+    a -= t[...,None]; a *= mx[...,None]; a += t[...,None]
+    np.clip(a, 0.0, 1.0, out=a)
+
+def vibrance(arr: np.ndarray, gain: float, keep: np.ndarray = None) -> None:
+    """Вибранс по полосам (in-place); общий для WOW (внутри tone_core) и Violin (с маской кожи)."""
+    h, w = arr.shape[:2]
+    bh   = min(h, TONE_BAND_ROWS)
+    M    = np.empty((bh, w), np.float32)
+    T    = np.empty((bh, w), np.float32)
+    for y0 in range(0, h, bh):
+        a = arr[y0:y0+bh]; n = a.shape[0]
+        _vibrance_band(a, gain, M[:n], T[:n], None if keep is None else keep[y0:y0+bh])
+
+def skin_mask(arr: np.ndarray, scale: float = None, feather: float = None) -> np.ndarray:
+    """
+    Маска кожи прямо из RGB [0..1] — те же пороги, что PIL-HSV (H 15..35, S>20, V>40 из 255),
+    без uint8/HSV-копий. scale<1 — считаем на уменьшенной копии и растягиваем; feather — мягкий край (px).
+    """
+    scale   = SKIN_MASK_SCALE if scale is None else scale
+    feather = SKIN_MASK_FEATHER if feather is None else feather
+    h, w = arr.shape[:2]
+    src  = arr
+    if scale < 1.0:
+        src = cv2.resize(arr, (max(1, int(w*scale)), max(1, int(h*scale))), interpolation=cv2.INTER_AREA)
+    sh, sw = src.shape[:2]
+    bh   = min(sh, TONE_BAND_ROWS)
+    mask = np.empty((sh, sw), np.float32)
+    mx   = np.empty((bh, sw), np.float32)
+    d    = np.empty((bh, sw), np.float32)
+    gb   = np.empty((bh, sw), np.float32)
+    for y0 in range(0, sh, bh):
+        a = src[y0:y0+bh]; n = a.shape[0]
+        r, g, b = a[...,0], a[...,1], a[...,2]
+        m, dd, q = mx[:n], d[:n], gb[:n]
+        np.maximum(g, b, out=m); red = r >= m              # тон считается от красного максимума
+        np.maximum(m, r, out=m)
+        np.minimum(g, b, out=dd); np.minimum(dd, r, out=dd)
+        np.subtract(m, dd, out=dd)                          # d = max - min
+        np.subtract(g, b, out=q)                            # hue*6*d = g - b
+        ok = red & (q >= dd*np.float32(6*15/255)) & (q < dd*np.float32(6*36/255))
+        ok &= dd*255 >= m*21                                # S > 20
+        ok &= m >= np.float32(41/255)                       # V > 40
+        mask[y0:y0+n] = ok
+    if (sh, sw) != (h, w):
+        mask = cv2.resize(mask, (w, h), interpolation=cv2.INTER_LINEAR)
+    if feather > 0:
+        cv2.GaussianBlur(mask, (0, 0), feather, dst=mask)
+    return mask
+
+def _l_mean(arr: np.ndarray) -> float:
+    """Средняя L (как у PIL) по полосам — без полноразмерного временного массива."""
+    w, acc = np.asarray(PIL_L_W, np.float32), 0.0
+    for y0 in range(0, arr.shape[0], TONE_BAND_ROWS):
+        acc += float(np.dot(arr[y0:y0+TONE_BAND_ROWS].reshape(-1, 3), w).sum(dtype=np.float64))
+    return acc / float(arr.shape[0] * arr.shape[1])
+
+def tone_affine(arr: np.ndarray, contrast: float = 1.0, brightness: float = 1.0, mean: float = None) -> None:
+    """
+    In-place аналог ImageEnhance.Contrast(c) -> Brightness(b) без uint8/PIL между шагами.
+    mean — средняя L всего кадра (0..1), если arr — только тайл.
+    """
+    mean = int(255.0*(_l_mean(arr) if mean is None else mean) + 0.5) / 255.0
+    k    = contrast * brightness
+    np.multiply(arr, k, out=arr)
+    arr += mean * (1.0 - contrast) * brightness
+    np.clip(arr, 0.0, 1.0, out=arr)
+
+# ---------- FILTERS (OpenCV + blur pyramid) ----------
+# Пост-стадии эффектов — на uint8 через OpenCV с теми же формулами, что у PIL
+# (GaussianBlur/UnsharpMask/blend/screen/Enhance), но в разы быстрее.
+BLUR_DIRECT_MAX_SIGMA = 3.0   # выше — размываем с уровня гауссовой пирамиды
+_TRUNC = -0.499               # PIL отбрасывает дробную часть, cv2 округляет — сдвигаем, чтобы не светлеть
+
+class BlurCache:
+    """
+    Размытия одной картинки (uint8 HxWx3) по требованию. Малые σ — прямой cv2.GaussianBlur,
+    большие — с уровня пирамиды (pyrDown строится один раз) + остаточное размытие + апскейл.
+    Повторный запрос того же σ отдаётся из кэша.
+    """
+    PYR_ALIGN = 64   # пирамиду строим с кадра, дополненного до кратного 64: апскейл ровно x2^k, тайлы совпадают с кадром
+
+    def __init__(self, img: np.ndarray):
+        self.img     = img
+        self._levels = None
+        self._memo   = {}
+
+    def _level(self, k: int) -> np.ndarray:
+        if self._levels is None:
+            h, w = self.img.shape[:2]
+            self._levels = [cv2.copyMakeBorder(self.img, 0, -h % self.PYR_ALIGN, 0, -w % self.PYR_ALIGN, cv2.BORDER_REPLICATE)]
+        while len(self._levels) <= k:
+            self._levels.append(cv2.pyrDown(self._levels[-1]))
+        return self._levels[k]
+
+    def blur(self, sigma: float) -> np.ndarray:
+        key = round(float(sigma), 3)
+        if key in self._memo:
+            return self._memo[key]
+        if sigma < 0.05:
+            out = self.img
+        elif sigma <= BLUR_DIRECT_MAX_SIGMA:
+            out = cv2.GaussianBlur(self.img, (0, 0), sigma, borderType=cv2.BORDER_REPLICATE)
+        else:
+            # уровень k уже несёт σ² = (4^k-1)/3 (pyrDown ≈ σ 1), билинейный апскейл ещё ≈ 4^k/6;
+            # остаток добираем обычным блюром на маленькой картинке
+            k = 1
+            while (1 << (k + 1)) <= self.PYR_ALIGN and min(self.img.shape[:2]) >> (k + 1) >= 8 \
+                    and sigma*sigma - ((4**(k+1) - 1)/3 + 4**(k+1)/6) >= 4**(k+1):
+                k += 1
+            rest = max(sigma*sigma - ((4**k - 1)/3 + 4**k/6), 0.0) ** 0.5 / (2**k)
+            small = self._level(k)
+            if rest >= 0.05:
+                small = cv2.GaussianBlur(small, (0, 0), rest, borderType=cv2.BORDER_REPLICATE)
+            h, w = self.img.shape[:2]
+            ph, pw = self._levels[0].shape[:2]
+            out = cv2.resize(small, (pw, ph), interpolation=cv2.INTER_LINEAR)[:h, :w]
+        self._memo[key] = out
+        return out
+
+def blend(a: np.ndarray, b: np.ndarray, alpha: float) -> np.ndarray:
+    """Image.blend: a*(1-alpha) + b*alpha."""
+    return cv2.addWeighted(a, 1.0 - alpha, b, alpha, _TRUNC)
+
+def screen(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """ImageChops.screen: 255 - (255-a)*(255-b)//255."""
+    prod = cv2.multiply(cv2.bitwise_not(a), cv2.bitwise_not(b), dtype=cv2.CV_16U)
+    return cv2.bitwise_not(cv2.addWeighted(prod, 1/255, prod, 0.0, _TRUNC, dtype=cv2.CV_8U))
+
+def unsharp(img: np.ndarray, radius: float, percent: int, threshold: int, cache: BlurCache = None) -> np.ndarray:
+    """ImageFilter.UnsharpMask: img + (img-blur)*percent/100 там, где |img-blur| >= threshold."""
+    if percent <= 0:
+        return img
+    diff  = cv2.subtract(img, (cache or BlurCache(img)).blur(radius), dtype=cv2.CV_16S)
+    sharp = cv2.addWeighted(img.astype(np.int16), 1.0, diff, percent/100.0, 0.0, dtype=cv2.CV_8U)
+    return np.where(np.abs(diff) >= threshold, sharp, img)
+
+def l_mean(img: np.ndarray) -> float:
+    """Средняя L (0..255) как у PIL convert('L')."""
+    return float(cv2.cvtColor(img, cv2.COLOR_RGB2GRAY).mean())
+
+def l_sum(img: np.ndarray) -> float:
+    """Сумма L по пикселям — чтобы сложить среднее кадра из тайлов."""
+    return l_mean(img) * img.shape[0] * img.shape[1]
+
+def enhance_color(img: np.ndarray, f: float) -> np.ndarray:
+    """ImageEnhance.Color: смесь с серой (L) копией."""
+    gray = cv2.cvtColor(cv2.cvtColor(img, cv2.COLOR_RGB2GRAY), cv2.COLOR_GRAY2RGB)
+    return blend(gray, img, f)
+
+def enhance_contrast(img: np.ndarray, f: float, mean: float = None) -> np.ndarray:
+    """ImageEnhance.Contrast: смесь с плоским серым цветом средней L (mean — по всему кадру, если img — тайл)."""
+    mean = int((l_mean(img) if mean is None else mean) + 0.5)
+    return cv2.addWeighted(img, f, img, 0.0, mean*(1.0 - f) + _TRUNC)
+
+def enhance_brightness(img: np.ndarray, f: float) -> np.ndarray:
+    """ImageEnhance.Brightness: смесь с чёрным."""
+    return cv2.addWeighted(img, f, img, 0.0, _TRUNC)
+
+# ---------- TILES ----------
+# Окрестные операции (блюры, unsharp) тянут соседей на ~3σ; тайл берём с ореолом, покрывающим
+# цепочку целиком, а в результат кладём только внутреннюю часть — швов нет. Статистики кадра
+# (средние для Contrast и анти-серости) считаются отдельным первым проходом.
+def tile_halo(*sigmas: float) -> int:
+    """Ореол под цепочку блюров с такими σ; кратен 64 — тогда уровни пирамиды BlurCache совпадают с полнокадровыми."""
+    reach = sum(int(4*s + 0.999) + 2 for s in sigmas)
+    return (reach + 63) // 64 * 64
+
+def run_tiles(src: np.ndarray, halo: int, fn, out: bool = True):
+    """
+    Кадр (uint8 HxWx3) по тайлам TILE_SIDE с ореолом halo: fn(тайл, inner) -> uint8 той же формы
+    (или None, если проход только собирает статистику); inner — срез внутренней части в координатах тайла.
+    Кадр не больше TILE_MAX_PX — одним тайлом, без копий (как раньше).
+    """
+    h, w = src.shape[:2]
+    if h * w <= TILE_MAX_PX:
+        return fn(src, (slice(0, h), slice(0, w)))
+    dst = np.empty_like(src) if out else None
+    for y0 in range(0, h, TILE_SIDE):
+        for x0 in range(0, w, TILE_SIDE):
+            y1, x1   = min(y0 + TILE_SIDE, h), min(x0 + TILE_SIDE, w)
+            hy0, hx0 = max(0, y0 - halo), max(0, x0 - halo)
+            inner = (slice(y0 - hy0, y1 - hy0), slice(x0 - hx0, x1 - hx0))
+            res = fn(src[hy0:min(h, y1 + halo), hx0:min(w, x1 + halo)], inner)
+            if dst is not None:
+                dst[y0:y1, x0:x1] = res[inner]
+    return dst
+
+def is_whole(tile: np.ndarray, src: np.ndarray) -> bool:
+    """Тайл — весь кадр: первый проход может отдать свой буфер второму вместо пересчёта."""
+    return tile.shape[:2] == src.shape[:2]
 
 # ---------- EFFECTS ----------
-def hdr_only_path(orig_path: str) -> str:
-    """Натуральный HDR-only для Nature Enhance 2.0 (без серости)."""
-    im = Image.open(orig_path).convert("RGB")
-    im = ImageOps.exif_transpose(im)
-    a = 3.0
-    arr = np.asarray(im).astype(np.float32)/255.0
-    luma = 0.2627*arr[...,0] + 0.6780*arr[...,1] + 0.0593*arr[...,2]
-    y    = np.log1p(a*luma) / (np.log1p(a)+1e-8)
-    ratio = y / np.maximum(luma, 1e-6)
-    arr = np.clip(arr * ratio[...,None], 0.0, 1.0)
-
-    out = Image.fromarray((arr*255).astype(np.uint8))
-    out = ImageEnhance.Brightness(out).enhance(1.00)
-    out = ImageEnhance.Contrast(out).enhance(1.06)
-
-    fd, path = tempfile.mkstemp(suffix=".jpg"); os.close(fd)
-    out.save(path, "JPEG", quality=95, optimize=True)
-    return path
-
-def wow_enhance_path(orig_path: str, ui_gain: float) -> str:
+# Вход — uint8 HxWx3 из load_input (Image тоже годится), выход — Image под энкод
+def hdr_only(im: np.ndarray) -> Image.Image:
+    """Натуральный HDR-only для Nature Enhance 2.0 (без серости). Всё поточечно — тайлы без ореола."""
+    src = np.asarray(im)
+    acc, keep = [0.0], {}
+
+    # проход 1: средняя L после HDR — для Contrast
+    def stats(tile, inner):
+        arr = _to_float(tile)
+        tone_core(arr, hdr_a=3.0)
+        acc[0] += _l_mean(arr) * arr.shape[0] * arr.shape[1]
+        if is_whole(tile, src): keep["arr"] = arr
+
+    def finish(tile, inner):
+        arr = keep.pop("arr", None)
+        if arr is None:
+            arr = _to_float(tile); tone_core(arr, hdr_a=3.0)
+        tone_affine(arr, contrast=1.06, brightness=1.00, mean=mean)
+        return _to_u8(arr)
+
+    run_tiles(src, 0, stats, out=False)
+    mean = acc[0] / (src.shape[0] * src.shape[1])
+    return Image.fromarray(run_tiles(src, 0, finish))
+
+def wow_enhance(base: np.ndarray, ui_gain: float) -> Image.Image:
     """
     WOW-пайплайн: сочный топ.
     ui_gain — мягкий множитель кнопки (0.1 / 0.50 / 1.00).
     """
-    g = float(ui_gain)
-
-    base = Image.open(orig_path).convert("RGB")
-    base = ImageOps.exif_transpose(base)
-    arr  = np.asarray(base).astype(np.float32)/255.0
-
-    # яркость для анти-серости
-    in_luma = 0.2627*arr[...,0] + 0.6780*arr[...,1] + 0.0593*arr[...,2]
-    in_mean = float(in_luma.mean())
-
-    # DRAMA: HDR (лог по луме)
-    A = DRAMA_HDR_LOGA_BASE * g
-    y = np.log1p(A*in_luma) / (np.log1p(A)+1e-8)
-    ratio = y / np.maximum(in_luma, 1e-6)
-    arr = np.clip(arr * ratio[...,None], 0.0, 1.0)
-
-    # DEPTH: S-curve
-    arr = _s_curve(arr, amt= DEPTH_S_CURVE_BASE * g)
-
-    # COLOR: Vibrance
-    arr = _vibrance(arr, gain= COLOR_VIBRANCE_BASE * g)
-
-    # COLOR глобальные
-    im = Image.fromarray((arr*255).astype(np.uint8))
-    im = ImageEnhance.Contrast(im).enhance(1.0 + COLOR_CONTRAST_BASE * g)
-    im = ImageEnhance.Brightness(im).enhance(1.0 + COLOR_BRIGHT_BASE  * g)
-
-    # DEPTH: Microcontrast (high-pass)
-    hp_r = DEPTH_HP_RADIUS_BASE * g
-    blurred = im.filter(ImageFilter.GaussianBlur(radius=hp_r))
-    hp = ImageChops.subtract(im, blurred)
-    hp = hp.filter(ImageFilter.UnsharpMask(radius=1.0, percent=int(90 + 110*g), threshold=3))
-    im = Image.blend(im, hp, min(0.6, DEPTH_MICROCONTR_BASE * g))
-
-    # DRAMA: Bloom хайлайтов
-    if DRAMA_BLOOM_AMOUNT > 0:
-        glow = im.filter(ImageFilter.GaussianBlur(radius=DRAMA_BLOOM_RADIUS + 4.0*g))
-        im = Image.blend(im, ImageChops.screen(im, glow), DRAMA_BLOOM_AMOUNT * g)
-
-    # DEPTH: финальный микрошарп
-    im = im.filter(ImageFilter.UnsharpMask(radius=1.0, percent=int(DEPTH_UNSHARP_BASE * g), threshold=2))
-
-    # анти-серость
-    out_mean = np.asarray(im.convert("L")).astype(np.float32).mean()/255.0
+    g   = float(ui_gain)
+    src = np.asarray(base)
+    acc, keep = dict(in_l=0.0, tone_l=0.0, out_l=0.0), {}
+
+    def tone(tile):
+        # DRAMA: HDR (лог по луме) + DEPTH: S-curve + COLOR: Vibrance — одним проходом
+        arr  = _to_float(tile)
+        in_l = tone_core(arr,
+                         hdr_a    = DRAMA_HDR_LOGA_BASE * g,
+                         s_amt    = DEPTH_S_CURVE_BASE * g,
+                         vib_gain = COLOR_VIBRANCE_BASE * g)
+        return arr, in_l
+
+    # проход 1 (поточечный): яркость входа — для анти-серости, средняя L после тона — для Contrast
+    def stats(tile, inner):
+        arr, in_l = tone(tile)
+        n = arr.shape[0] * arr.shape[1]
+        acc["in_l"] += in_l * n; acc["tone_l"] += _l_mean(arr) * n
+        if is_whole(tile, src): keep["arr"] = arr
+
+    def finish(tile, inner):
+        arr = keep.pop("arr", None)
+        if arr is None:
+            arr, _ = tone(tile)
+
+        # COLOR глобальные
+        tone_affine(arr, contrast=1.0 + COLOR_CONTRAST_BASE * g, brightness=1.0 + COLOR_BRIGHT_BASE * g, mean=tone_mean)
+        im = _to_u8(arr); del arr
+
+        # DEPTH: Microcontrast (high-pass)
+        hp = cv2.subtract(im, BlurCache(im).blur(DEPTH_HP_RADIUS_BASE * g))
+        hp = unsharp(hp, radius=1.0, percent=int(90 + 110*g), threshold=3)
+        im = blend(im, hp, min(0.6, DEPTH_MICROCONTR_BASE * g))
+
+        # DRAMA: Bloom хайлайтов
+        if DRAMA_BLOOM_AMOUNT > 0:
+            glow = BlurCache(im).blur(DRAMA_BLOOM_RADIUS + 4.0*g)
+            im = blend(im, screen(im, glow), DRAMA_BLOOM_AMOUNT * g)
+
+        # DEPTH: финальный микрошарп
+        im = unsharp(im, radius=1.0, percent=int(DEPTH_UNSHARP_BASE * g), threshold=2)
+        acc["out_l"] += l_sum(im[inner])
+        return im
+
+    npx = src.shape[0] * src.shape[1]
+    run_tiles(src, 0, stats, out=False)
+    in_mean, tone_mean = acc["in_l"] / npx, acc["tone_l"] / npx
+    halo = tile_halo(DEPTH_HP_RADIUS_BASE * g, 1.0, DRAMA_BLOOM_RADIUS + 4.0*g, 1.0)
+    im   = run_tiles(src, halo, finish)
+
+    # анти-серость (поточечно, по полосам прямо в готовом кадре)
+    out_mean = acc["out_l"] / npx / 255.0
     if out_mean < in_mean * ANTI_GREY_TOL:
         gain = min(ANTI_GREY_CAP, max(1.00, (in_mean / max(out_mean, 1e-6)) ** 0.85))
-        im = ImageEnhance.Brightness(im).enhance(gain)
-
-    fd, path = tempfile.mkstemp(suffix=".jpg"); os.close(fd)
-    im.save(path, "JPEG", quality=95, optimize=True)
-    return path
+        for y0 in range(0, im.shape[0], TILE_SIDE):
+            band = im[y0:y0+TILE_SIDE]
+            band[...] = enhance_brightness(band, gain)
+    return Image.fromarray(im)
 
 def violin_touch_base(arr: np.ndarray) -> np.ndarray:
     """Общий каркас Violin (без финальных PIL-процедур), чтобы делать v1 и v2."""
-    # 1) HDR-лог мягче (чтобы не высветлять)
-    l = 0.2627*arr[...,0] + 0.6780*arr[...,1] + 0.0593*arr[...,2]
-    A = 2.7
-    y = np.log1p(A*l) / (np.log1p(A)+1e-8)
-    arr = np.clip(arr * (y/np.maximum(l,1e-6))[...,None], 0, 1)
-
-    # 2) Плёночная S-кривая (чуть сильнее для объёма)
-    arr = _s_curve(arr, amt=0.24)
+    # 1) HDR-лог мягче (чтобы не высветлять) + 2) плёночная S-кривая (чуть сильнее для объёма)
+    tone_core(arr, hdr_a=2.7, s_amt=0.24)
 
     # 3) Vibrance с защитой кожи
-    im_hsv = Image.fromarray((arr*255).astype(np.uint8)).convert("HSV")
-    hsv    = np.asarray(im_hsv).astype(np.float32)
-    H,S,V  = hsv[...,0], hsv[...,1], hsv[...,2]
-    skin = (((H>=15) & (H<=35)) & (S>20) & (V>40)).astype(np.float32)
-
-    def _vib(a, gain):
-        mx = a.max(axis=-1, keepdims=True); mn = a.min(axis=-1, keepdims=True)
-        sat = mx - mn; w = 1.0 - sat; mean = a.mean(axis=-1, keepdims=True)
-        return np.clip(mean + (a-mean)*(1.0 + gain*w), 0.0, 1.0)
-
-    vib_gain = 0.48
-    vib = _vib(arr, vib_gain)
-    arr = np.clip(arr*(skin[...,None]) + vib*(1.0-skin[...,None]), 0, 1)
-
+    vibrance(arr, VIOLIN_VIBRANCE, keep=skin_mask(arr))
     return arr
 
-def violin_touch_v1_path(orig_path: str) -> str:
+def violin_touch(base: np.ndarray, hp_a: float, glow_a: float, color: float, contrast: float, sharpen: int) -> Image.Image:
+    """
+    Каркас + локальный контраст/bloom + общие правки. Contrast смешивает со средней L всего кадра
+    после цвета — её считает первый проход (конвейер до цвета, с ореолом); его uint8-результат
+    собирается в буфер размером с кадр, и второй проход (Contrast + unsharp) идёт уже по нему.
+    """
+    src = np.asarray(base)
+    acc = [0.0]
+
+    def front(tile):
+        im = _to_u8(violin_touch_base(_to_float(tile)))
+        # Локальный контраст + лёгкий bloom
+        hp = cv2.subtract(im, BlurCache(im).blur(1.2))
+        im = blend(im, hp, hp_a)
+        glow = BlurCache(im).blur(2.0)
+        im = blend(im, screen(im, glow), glow_a)
+        return enhance_color(im, color)
+
+    def stats(tile, inner):
+        im = front(tile)
+        acc[0] += l_sum(im[inner])
+        return im
+
+    def finish(tile, inner):
+        im = enhance_contrast(tile, contrast, mean=mean)
+        return unsharp(im, radius=1.0, percent=sharpen, threshold=2)
+
+    mid  = run_tiles(src, tile_halo(SKIN_MASK_FEATHER, 1.2, 2.0), stats)
+    mean = acc[0] / (src.shape[0] * src.shape[1])
+    return Image.fromarray(run_tiles(mid, tile_halo(1.0), finish))
+
+def violin_touch_v1(base: np.ndarray) -> Image.Image:
     """Violin Усиление (как у тебя было)."""
-    base = Image.open(orig_path).convert("RGB")
-    base = ImageOps.exif_transpose(base)
-    arr  = np.asarray(base).astype(np.float32)/255.0
-
-    arr = violin_touch_base(arr)
-    im  = Image.fromarray((arr*255).astype(np.uint8))
-
-    # Локальный контраст + лёгкий bloom
-    hp = ImageChops.subtract(im, im.filter(ImageFilter.GaussianBlur(radius=1.2)))
-    im = Image.blend(im, hp, 0.32)
-    glow = im.filter(ImageFilter.GaussianBlur(radius=2.0))
-    im = Image.blend(im, ImageChops.screen(im, glow), 0.04)
-
-    # Общие правки
-    im = ImageEnhance.Color(im).enhance(1.08)
-    im = ImageEnhance.Contrast(im).enhance(1.14)
-    im = ImageEnhance.Brightness(im).enhance(1.00)
-    im = im.filter(ImageFilter.UnsharpMask(radius=1.0, percent=120, threshold=2))
-
-    fd, path = tempfile.mkstemp(suffix=".jpg"); os.close(fd)
-    im.save(path, "JPEG", quality=95, optimize=True)
-    return path
-
-def violin_touch_v2_path(orig_path: str) -> str:
+    return violin_touch(base, hp_a=0.32, glow_a=0.04, color=1.08, contrast=1.14, sharpen=120)
+
+def violin_touch_v2(base: np.ndarray) -> Image.Image:
     """Violin Усиление 2 — на ~10% сочнее/глубже ДО Clarity."""
-    base = Image.open(orig_path).convert("RGB")
-    base = ImageOps.exif_transpose(base)
-    arr  = np.asarray(base).astype(np.float32)/255.0
+    return violin_touch(base,
+                        hp_a=0.36, glow_a=0.05,        # было 0.32 / 0.04 — чуть больше локального контраста и bloom
+                        color=1.12, contrast=1.18,     # было 1.08 / 1.14 — больше цвета/панча (без осветления)
+                        sharpen=125)
 
-    arr = violin_touch_base(arr)
-    im  = Image.fromarray((arr*255).astype(np.uint8))
+def local_upscale(im: Image.Image, scale: float, max_side: int = None) -> Image.Image:
+    """
+    Воркер пула: замена Clarity, когда он недоступен. Выход того же размера, что отдал бы Clarity
+    (кадр, ужатый до max_side, x scale): Lanczos + лёгкий unsharp по тайлам.
+    """
+    max_side = max_side or CLARITY_INPUT_MAX_SIDE
+    k    = scale * min(1.0, max_side / max(im.size))
+    size = (round(im.size[0] * k), round(im.size[1] * k))
+    big  = cv2.resize(np.asarray(im), size, interpolation=cv2.INTER_LANCZOS4)
+    sh   = FALLBACK_SHARPEN
+    return Image.fromarray(run_tiles(big, tile_halo(sh["radius"]),
+                                     lambda tile, inner: unsharp(tile, sh["radius"], sh["percent"], sh["threshold"])))
+
+def render_local(data: bytes, effect: str, ui_gain: float = UI_MED) -> tuple:
+    """
+    Воркер пула: байты из Telegram -> готовая локальная картинка (без промежуточных файлов).
+    -> (Image, {"decode": сек, "effect": сек}) — тайминги для трейса в основном процессе.
+    """
+    t0 = time.perf_counter()
+    im = load_input(data, INPUT_MAX_SIDE)
+    t1 = time.perf_counter()
+    if effect == "ne2":             im = hdr_only(im)
+    elif effect == "violin_boost":  im = violin_touch_v1(im)
+    elif effect == "violin_boost2": im = violin_touch_v2(im)
+    else:                           im = wow_enhance(im, ui_gain)
+    return im, {"decode": t1 - t0, "effect": time.perf_counter() - t1}
+
+# ---------- METRICS ----------
+LATENCY_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160, 320)
+
+def _fmt_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{n}="{str(v)}"' for n, v in zip(names, values)]
+    if extra: parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Histogram:
+    """Минимальная Prometheus-гистограмма с метками (без внешних зависимостей)."""
+    def __init__(self, name: str, doc: str, labels: tuple, buckets: tuple = LATENCY_BUCKETS):
+        self.name, self.doc, self.labels, self.buckets = name, doc, labels, buckets
+        self._series = {}   # values -> [counts по бакетам..., sum, count]
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(n, "") for n in self.labels)
+        row = self._series.get(key)
+        if row is None:
+            row = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+        for i, b in enumerate(self.buckets):
+            if value <= b: row[i] += 1
+        row[-2] += value; row[-1] += 1
+
+    def render(self) -> list:
+        out = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        for key, row in sorted(self._series.items()):
+            for b, c in list(zip(self.buckets, row)) + [("+Inf", row[-1])]:
+                le = 'le="%s"' % b
+                out.append(f"{self.name}_bucket{_fmt_labels(self.labels, key, le)} {c}")
+            out.append(f"{self.name}_sum{_fmt_labels(self.labels, key)} {row[-2]:.6f}")
+            out.append(f"{self.name}_count{_fmt_labels(self.labels, key)} {row[-1]}")
+        return out
+
+class Counter:
+    def __init__(self, name: str, doc: str, labels: tuple = ()):
+        self.name, self.doc, self.labels = name, doc, labels
+        self._series = {}
+
+    def inc(self, n: float = 1, **labels):
+        key = tuple(labels.get(l, "") for l in self.labels)
+        self._series[key] = self._series.get(key, 0) + n
+
+    def render(self) -> list:
+        out = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} counter"]
+        out += [f"{self.name}{_fmt_labels(self.labels, k)} {v}" for k, v in sorted(self._series.items())]
+        return out
+
+class Gauge:
+    """
+    Значение снимается при каждом scrape: fn() -> число или {(метки...): число}.
+    kind="counter" — для уже существующих монотонных счётчиков (RESULT_CACHE.stats и т.п.).
+    """
+    def __init__(self, name: str, doc: str, fn, labels: tuple = (), kind: str = "gauge"):
+        self.name, self.doc, self.fn, self.labels, self.kind = name, doc, fn, labels, kind
+
+    def render(self) -> list:
+        out = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"]
+        val = self.fn()
+        items = val.items() if isinstance(val, dict) else [((), val)]
+        out += [f"{self.name}{_fmt_labels(self.labels, k)} {v}" for k, v in sorted(items)]
+        return out
+
+METRICS = []
+
+def metric(m):
+    METRICS.append(m); return m
+
+def render_metrics() -> str:
+    lines = []
+    for m in METRICS:
+        lines += m.render()
+    return "\n".join(lines) + "\n"
+
+STAGE_SECONDS   = metric(Histogram("nature_stage_seconds", "Время стадии обработки фото",
+                                   ("stage", "effect", "strength")))
+REQUEST_SECONDS = metric(Histogram("nature_request_seconds", "Полное время обработки фото",
+                                   ("effect", "strength", "outcome")))
+CLARITY_JOBS    = metric(Counter("nature_clarity_jobs_total", "Clarity-задачи по исходу", ("effect", "outcome")))
+CLARITY_FALLBACKS = metric(Counter("nature_clarity_fallbacks_total", "Фото, отданные с локальным апскейлом вместо Clarity",
+                                   ("effect", "reason")))
+metric(Gauge("nature_clarity_breaker_state", "Состояние предохранителя Clarity (1 — текущее)",
+             lambda: {(s,): int(CLARITY.breaker.state == s) for s in ("closed", "open", "half_open")}, ("state",)))
+metric(Gauge("nature_clarity_breaker_trips_total", "Сколько раз предохранитель Clarity размыкался",
+             lambda: CLARITY.breaker.trips, kind="counter"))
+metric(Gauge("nature_pool_queue_depth", "Фото, ждущие воркера на CPU-стадиях (сверх занятых)", lambda: POOL.queued()))
+metric(Gauge("nature_pool_pending", "Фото на CPU-стадиях: рендер и энкод (в пуле + в очереди; Clarity не считается)",
+             lambda: POOL.pending))
+metric(Gauge("nature_pool_restarts_total", "Перезапуски пула после смерти воркера", lambda: POOL.restarts, kind="counter"))
+metric(Gauge("nature_clarity_inflight", "Clarity prediction'ы в работе", lambda: CLARITY.inflight))
+metric(Gauge("nature_clarity_pending", "Фото на стадии Clarity (превью отдано, место в очереди пула освобождено)",
+             lambda: CLARITY.pending))
+JOBS_DROPPED    = metric(Counter("nature_jobs_dropped_total", "Фото, снятые до обработки", ("reason",)))
+metric(Gauge("nature_sched_waiting", "Ждут слота в планировщике",
+             lambda: {(g.name, c): g.waiting(f) for g in (POOL.gate, CLARITY.gate) for f, c in ((True, "fast"), (False, "normal"))},
+             ("gate", "class")))
+metric(Gauge("nature_sched_running", "Занятые слоты планировщика",
+             lambda: {(g.name,): g.running for g in (POOL.gate, CLARITY.gate)}, ("gate",)))
+WEBHOOK_UPDATES = metric(Counter("nature_webhook_updates_total", "Апдейты, пришедшие через webhook", ("result",)))
+metric(Gauge("nature_webhook_inflight", "Апдейты из webhook, которые ещё обрабатываются", lambda: len(UPDATE_TASKS)))
+metric(Gauge("nature_cache_events_total", "События кэша результатов",
+             lambda: {(k,): v for k, v in RESULT_CACHE.stats.items()}, ("event",), kind="counter"))
+metric(Gauge("nature_cache_hit_ratio", "Доля попаданий в кэш результатов", lambda: round(RESULT_CACHE.hit_rate(), 4)))
+
+STRENGTH_NAMES = {UI_LOW: "low", UI_MED: "medium", UI_HIGH: "high"}
+
+class Trace:
+    """Тайминги стадий одного фото -> STAGE_SECONDS/REQUEST_SECONDS с метками effect/strength."""
+    def __init__(self, effect: str, ui_gain: float = None):
+        strength = STRENGTH_NAMES.get(ui_gain, "-") if effect == "wow" else "-"
+        self.labels = dict(effect=effect, strength=strength)
+        self.stages = {}
+        self.t0     = time.monotonic()
+
+    def add(self, stage: str, seconds: float):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+        STAGE_SECONDS.observe(seconds, stage=stage, **self.labels)
+
+    @contextlib.contextmanager
+    def stage(self, stage: str):
+        t = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(stage, time.monotonic() - t)
+
+    def finish(self, outcome: str):
+        total = time.monotonic() - self.t0
+        REQUEST_SECONDS.observe(total, outcome=outcome, **self.labels)
+        logging.info("trace %s/%s %s: %.2fs %s", self.labels["effect"], self.labels["strength"], outcome, total,
+                     " ".join(f"{k}={v:.2f}" for k, v in self.stages.items()))
+
+async def on_metrics(request: web.Request) -> web.Response:
+    return web.Response(body=render_metrics().encode("utf-8"),
+                        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+async def on_health(request: web.Request) -> web.Response:
+    if POOL.broken:
+        return web.Response(status=503, text="render pool broken")   # поднимется на следующей задаче
+    return web.Response(text="ok")
+
+def make_web_app(webhook: bool = False) -> web.Application:
+    app = web.Application()
+    app.router.add_get("/metrics", on_metrics)
+    app.router.add_get("/healthz", on_health)
+    if webhook:
+        app.router.add_post(WEBHOOK_PATH, on_webhook)   # определён ниже, в WEBHOOK
+    return app
+
+# ---------- SCHEDULER ----------
+class JobCancelled(Exception):
+    """Задачу сняли из очереди (/cancel) — до слота она так и не дошла."""
+
+class Job:
+    """Чья задача и какого класса: fast — дешёвый локальный путь (ne2), обслуживается раньше."""
+    __slots__ = ("uid", "fast")
+    def __init__(self, uid: int, fast: bool = False):
+        self.uid, self.fast = uid, fast
+
+# Job текущего фото; ставится в on_photo, его видят POOL.run и CLARITY.run (наследуется задачами)
+CURRENT_JOB = contextvars.ContextVar("nature_job", default=None)
+
+class FairScheduler:
+    """
+    Честная раздача slots одинаковых слотов (воркеры пула, Clarity): у каждого пользователя своя
+    FIFO-очередь, пользователи обслуживаются по кругу, класс fast — раньше обычного; одному
+    пользователю — не больше per_user слотов разом. Служебные задачи без Job — общая очередь uid=None.
+    """
+    def __init__(self, name: str, slots: int, per_user: int = 0):
+        self.name     = name
+        self.slots    = max(1, slots)
+        self.per_user = per_user if per_user > 0 else self.slots
+        self.running  = 0
+        self._user_running = {}
+        self._queues = {True: OrderedDict(), False: OrderedDict()}   # fast -> uid -> deque[Future]
+
+    def waiting(self, fast: bool) -> int:
+        return sum(len(q) for q in self._queues[fast].values())
+
+    def _next(self):
+        for fast in (True, False):
+            q = self._queues[fast]
+            for uid in q:
+                limit = self.slots if uid is None else self.per_user
+                if self._user_running.get(uid, 0) >= limit:
+                    continue
+                futs = q.pop(uid)
+                fut  = futs.popleft()
+                if futs:
+                    q[uid] = futs   # остаток — в конец круга
+                return uid, fut
+        return None
+
+    def _dispatch(self):
+        while self.running < self.slots:
+            nxt = self._next()
+            if nxt is None:
+                return
+            uid, fut = nxt
+            self.running += 1
+            self._user_running[uid] = self._user_running.get(uid, 0) + 1
+            fut.set_result(None)
+
+    def _drop(self, fast: bool, uid, fut):
+        futs = self._queues[fast].get(uid)
+        if futs and fut in futs:
+            futs.remove(fut)
+            if not futs:
+                del self._queues[fast][uid]
+
+    async def acquire(self, job: Job = None):
+        uid, fast = (job.uid, job.fast) if job else (None, False)
+        fut = asyncio.get_running_loop().create_future()
+        self._queues[fast].setdefault(uid, deque()).append(fut)
+        self._dispatch()
+        try:
+            await fut
+        except BaseException:
+            if fut.done() and not fut.cancelled() and fut.exception() is None:
+                self.release(job)   # слот успели выдать, а задачу в этот момент отменили
+            else:
+                self._drop(fast, uid, fut)
+            raise
+
+    def release(self, job: Job = None):
+        uid = job.uid if job else None
+        self.running -= 1
+        left = self._user_running.pop(uid) - 1
+        if left:
+            self._user_running[uid] = left
+        self._dispatch()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, job: Job = None):
+        await self.acquire(job)
+        try:
+            yield
+        finally:
+            self.release(job)
+
+    def cancel(self, uid: int) -> int:
+        """Снимает все ждущие задачи пользователя (уже работающие не трогаем) -> сколько сняли."""
+        n = 0
+        for q in self._queues.values():
+            for fut in q.pop(uid, ()):
+                if not fut.done():
+                    fut.set_exception(JobCancelled()); n += 1
+        return n
+
+class RateLimiter:
+    """Token bucket на пользователя. allow(uid, cost) -> 0, если можно, иначе сколько секунд подождать."""
+    def __init__(self, per_min: float, burst: int, max_users: int = 100000):
+        self.rate, self.burst, self.max_users = per_min / 60.0, max(1, burst), max_users
+        self._b = OrderedDict()   # uid -> (токены, момент); порядок — по последнему фото
+
+    def allow(self, uid: int, cost: int = 1) -> float:
+        if self.rate <= 0:
+            return 0.0
+        now  = time.monotonic()
+        cost = min(cost, self.burst)   # альбом больше burst всё равно пропускаем, как только ведро полное
+        tokens, t = self._b.pop(uid, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - t) * self.rate)
+        if tokens < cost:
+            self._b[uid] = (tokens, now)
+            return (cost - tokens) / self.rate
+        self._b[uid] = (tokens - cost, now)
+        while len(self._b) > self.max_users:
+            self._b.popitem(last=False)   # самые давние — их ведро и так уже полное
+        return 0.0
+
+LIMITER = RateLimiter(USER_RATE_PER_MIN, USER_RATE_BURST)
 
-    # Чуть больше локального контраста и bloom
-    hp = ImageChops.subtract(im, im.filter(ImageFilter.GaussianBlur(radius=1.2)))
-    im = Image.blend(im, hp, 0.36)  # было 0.32
-    glow = im.filter(ImageFilter.GaussianBlur(radius=2.0))
-    im = Image.blend(im, ImageChops.screen(im, glow), 0.05)  # было 0.04
+# ---------- CLARITY (мягкий пост-проход) ----------
+class ClarityError(Exception):
+    pass
 
-    # Чуть больше цвета/панча (без осветления)
-    im = ImageEnhance.Color(im).enhance(1.12)     # было 1.08
-    im = ImageEnhance.Contrast(im).enhance(1.18)  # было 1.14
-    im = ImageEnhance.Brightness(im).enhance(1.00)
-    im = im.filter(ImageFilter.UnsharpMask(radius=1.0, percent=125, threshold=2))
+class ClarityUnavailable(ClarityError):
+    """Clarity даже не звали: reason = breaker_open (предохранитель разомкнут) | budget (бюджет съела очередь)."""
+    def __init__(self, reason: str, msg: str = ""):
+        super().__init__(f"{reason}: {msg}" if msg else reason)
+        self.reason = reason
 
-    fd, path = tempfile.mkstemp(suffix=".jpg"); os.close(fd)
-    im.save(path, "JPEG", quality=95, optimize=True)
-    return path
+class CircuitBreaker:
+    """
+    closed -(threshold неудач подряд)-> open -(cooldown)-> half_open: пропускаем одну пробу;
+    проба удалась — closed, упала — снова open с удвоенной паузой (не больше cooldown_max_s).
+    Состояние — на процесс (воркеры пула Clarity не зовут).
+    """
+    def __init__(self, name: str, threshold: int, cooldown_s: float, cooldown_max_s: float):
+        self.name      = name
+        self.threshold = max(1, threshold)
+        self.cooldown_base = cooldown_s
+        self.cooldown_max  = max(cooldown_s, cooldown_max_s)
+        self.cooldown  = cooldown_s
+        self.state     = "closed"
+        self.fails     = 0
+        self.opened_at = 0.0
+        self.probing   = False
+        self.trips     = 0
+
+    def is_open(self) -> bool:
+        """Без побочных эффектов: звать сейчас точно бесполезно (пауза не вышла или проба уже идёт)."""
+        if self.state == "open":
+            return time.monotonic() - self.opened_at < self.cooldown
+        return self.state == "half_open" and self.probing
+
+    def allow(self) -> bool:
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.cooldown:
+            self.state, self.probing = "half_open", False
+            logging.info("%s breaker: half-open, probing", self.name)
+        if self.state == "closed":
+            return True
+        if self.state == "half_open" and not self.probing:
+            self.probing = True
+            return True
+        return False
+
+    def success(self):
+        if self.state != "closed":
+            logging.info("%s breaker: closed", self.name)
+        self.state, self.fails, self.probing = "closed", 0, False
+        self.cooldown = self.cooldown_base
+
+    def failure(self):
+        self.fails += 1
+        if self.state == "half_open":
+            self.cooldown = min(self.cooldown_max, self.cooldown * 2)
+            self._open()
+        elif self.state == "closed" and self.fails >= self.threshold:
+            self._open()
+
+    def release_probe(self):
+        """Проба не дошла до исхода (отменили) — следующий вызов снова может стать пробой."""
+        self.probing = False
+
+    def _open(self):
+        self.state, self.opened_at, self.probing = "open", time.monotonic(), False
+        self.trips += 1
+        logging.warning("%s breaker: open for %.0fs after %d failure(s) in a row", self.name, self.cooldown, self.fails)
+
+class ClarityClient:
+    """
+    Async-клиент Replicate: создаёт prediction, поллит его без блокировок,
+    держит не больше max_inflight одновременно, режет по дедлайну и отменяет брошенные.
+    Последние задачи (ожидание слота, время работы, исход) лежат в self.jobs.
+    """
+    def __init__(self, base: str, token: str, max_inflight: int, deadline_s: float):
+        self.base       = base
+        self.token      = token
+        self.deadline_s = deadline_s
+        self.max_inflight = max(1, max_inflight)
+        self.inflight   = 0
+        self.pending    = 0     # фото на стадии Clarity целиком (ожидание, prediction, скачивание или апскейл)
+        self.jobs       = deque(maxlen=200)
+        self.cancels    = set()   # фоновые отмены брошенных prediction'ов (ссылки держим, чтобы задачи не собрал GC)
+        self.gate       = FairScheduler("clarity", self.max_inflight, USER_CLARITY_MAX)
+        self.breaker    = CircuitBreaker("clarity", CLARITY_BREAKER_FAILS, CLARITY_BREAKER_COOLDOWN_S,
+                                         CLARITY_BREAKER_COOLDOWN_MAX_S)
+
+    @contextlib.contextmanager
+    def stage(self):
+        self.pending += 1
+        try:
+            yield
+        finally:
+            self.pending -= 1
+
+    async def _call(self, method: str, url: str, payload: dict = None) -> dict:
+        session = await bot.get_session()
+        headers = {"Authorization": f"Bearer {self.token}", "Content-Type": "application/json"}
+        timeout = aiohttp.ClientTimeout(total=30)
+        async with session.request(method, url, json=payload, headers=headers, timeout=timeout) as r:
+            if r.status >= 400:
+                raise ClarityError(f"{method} {url}: HTTP {r.status} {(await r.text())[:200]}")
+            return await r.json()
+
+    async def _cancel(self, pred: dict):
+        url = (pred.get("urls") or {}).get("cancel") or f"{self.base}/v1/predictions/{pred['id']}/cancel"
+        try:
+            await self._call("POST", url)
+        except Exception as e:
+            logging.warning("clarity: cancel %s failed: %s", pred.get("id"), e)
 
-# ---------- CLARITY (мягкий пост-проход) ----------
-def clarity_post_path(local_path: str, cfg: dict = None) -> str:
-    """Нежный Clarity как финальный штрих. Если токена/репликейта нет — вернём исходник."""
-    if not (REPL_TOKEN and replicate):
-        return local_path
-    C = (cfg or CL_BASE)
-    try:
-        with open(local_path, "rb") as f:
-            out = replicate.run(MODEL_CLARITY, input={
-                "image": f,
+    async def _predict(self, version: str, inp: dict) -> dict:
+        pred = await self._call("POST", f"{self.base}/v1/predictions", {"version": version, "input": inp})
+        try:
+            delay = CLARITY_POLL_MIN_S
+            while pred.get("status") not in ("succeeded", "failed", "canceled"):
+                await asyncio.sleep(delay)
+                delay = min(CLARITY_POLL_MAX_S, delay * 1.5)
+                url  = (pred.get("urls") or {}).get("get") or f"{self.base}/v1/predictions/{pred['id']}"
+                pred = await self._call("GET", url)
+            return pred
+        except BaseException:
+            # таймаут/отмена задачи — prediction на стороне Replicate больше никому не нужен
+            if pred.get("status") not in ("succeeded", "failed", "canceled"):
+                task = asyncio.ensure_future(self._cancel(pred))
+                self.cancels.add(task)
+                task.add_done_callback(self.cancels.discard)
+            raise
+
+    async def drain(self, timeout: float = 10.0):
+        """Перед закрытием сессии: дожидаемся отмен, иначе брошенные prediction'ы так и досчитаются (и спишутся)."""
+        if self.cancels:
+            logging.info("clarity: waiting for %d cancel(s)", len(self.cancels))
+            await asyncio.wait(set(self.cancels), timeout=timeout)
+
+    async def run(self, model: str, inp: dict, tag: str = "", trace: "Trace" = None, budget_s: float = None):
+        """
+        Отдаёт output prediction'а; ClarityError / asyncio.TimeoutError при неудаче, ClarityUnavailable —
+        предохранитель разомкнут или бюджет (budget_s, не больше дедлайна) ушёл на очередь, JobCancelled — сняли из очереди.
+        Исходы prediction'ов (но не пропуски) ведут предохранитель.
+        """
+        version = model.split(":", 1)[-1]
+        budget  = min(budget_s or self.deadline_s, self.deadline_s)
+        t0 = time.monotonic(); t1 = None; outcome = "error"; called = probe = False
+        try:
+            async with self.gate.slot(CURRENT_JOB.get()):
+                t1 = time.monotonic()
+                left = budget - (t1 - t0)
+                if left < CLARITY_MIN_RUN_S:
+                    outcome = "budget"
+                    raise ClarityUnavailable(outcome, f"{left:.0f}s left after queue")
+                if not self.breaker.allow():
+                    outcome = "breaker_open"
+                    raise ClarityUnavailable(outcome)
+                called, probe = True, self.breaker.state == "half_open"
+                self.inflight += 1
+                try:
+                    pred = await asyncio.wait_for(self._predict(version, inp), timeout=left)
+                finally:
+                    self.inflight -= 1
+            if pred.get("status") != "succeeded":
+                outcome = pred.get("status") or "error"
+                raise ClarityError(f"prediction {pred.get('id')} {outcome}: {pred.get('error')}")
+            outcome = "ok"
+            return pred.get("output")
+        except asyncio.TimeoutError:
+            outcome = "timeout"; raise
+        except (asyncio.CancelledError, JobCancelled):
+            outcome = "cancelled"; raise
+        finally:
+            if called:
+                if outcome == "ok":          self.breaker.success()
+                elif outcome != "cancelled": self.breaker.failure()
+                elif probe:                  self.breaker.release_probe()
+            t2 = time.monotonic()
+            job = dict(tag=tag, outcome=outcome,
+                       wait_s=round((t1 or t2) - t0, 3), run_s=round(t2 - (t1 or t2), 3))
+            self.jobs.append(job)
+            CLARITY_JOBS.inc(effect=tag, outcome=outcome)
+            if trace:
+                trace.add("clarity_wait", job["wait_s"]); trace.add("clarity_run", job["run_s"])
+            logging.info("clarity %s: %s (wait %.1fs, run %.1fs)", tag, outcome, job["wait_s"], job["run_s"])
+
+CLARITY = ClarityClient(REPLICATE_API_BASE, REPL_TOKEN, CLARITY_MAX_INFLIGHT, CLARITY_DEADLINE_S)
+
+async def clarity_post(im: Image.Image, cfg: dict = None, tag: str = "", trace: Trace = None) -> tuple:
+    """
+    Нежный Clarity как финальный штрих -> (картинка, via): clarity | local — Clarity недоступен (предохранитель,
+    бюджет, ошибка), отдаём локальный апскейл того же размера | cancelled — сняли из очереди, картинка та же.
+    Без токена Clarity не вызывается вовсе — (im, "off").
+    """
+    if not REPL_TOKEN:
+        return im, "off"
+    with CLARITY.stage():
+        C = (cfg or CL_BASE)
+        try:
+            if CLARITY.breaker.is_open():
+                raise ClarityUnavailable("breaker_open")   # не тратим энкод и очередь
+            # транспортный энкод для Replicate (не больше CLARITY_INPUT_MAX_SIDE); финальный JPEG для Telegram всё равно один
+            upload = await POOL.run(clarity_input, im)
+            image  = "data:image/jpeg;base64," + base64.b64encode(upload).decode("ascii")
+            out = await CLARITY.run(MODEL_CLARITY, {
+                "image": image,
                 "prompt": "<lora:more_details:%s>\n<lora:SDXLrender_v2.0:%s>" % (C["lora_more_details"], C["lora_render"]),
                 "negative_prompt": C["negative_prompt"],
                 "scale_factor": C["scale_factor"],
@@ -343,19 +1382,230 @@ def clarity_post_path(local_path: str, cfg: dict = None) -> str:
                 "handfix": "disabled",
                 "output_format": "png",
                 "seed": 1337
-            })
-        url = _pick_first_url(out)
-        if not url:
-            return local_path
-        new_path = download_to_temp(url, ".png")
-        im = Image.open(new_path).convert("RGB")
-        fd, jpg = tempfile.mkstemp(suffix=".jpg"); os.close(fd)
-        im.save(jpg, "JPEG", quality=95, optimize=True)
-        try: os.remove(new_path)
-        except: pass
-        return jpg
-    except Exception:
-        return local_path
+            }, tag=tag, trace=trace, budget_s=CLARITY_BUDGET_S.get(tag))
+            url = _pick_first_url(out)
+            if not url:
+                raise ClarityError(f"empty output {out!r}")
+            with (trace.stage("clarity_fetch") if trace else contextlib.nullcontext()):
+                png = await http_fetch(url, CLARITY_FETCH_MAX)
+                return await POOL.run(decode_image, png), "clarity"
+        except JobCancelled:
+            logging.info("clarity %s: cancelled in queue, keeping local render", tag)
+            return im, "cancelled"
+        except (ClarityError, asyncio.TimeoutError, aiohttp.ClientError, DownloadTooLarge) as e:
+            reason = getattr(e, "reason", None) or ("timeout" if isinstance(e, asyncio.TimeoutError) else "error")
+            logging.warning("clarity %s: %s, local upscale instead: %r", tag, reason, e)
+            CLARITY_FALLBACKS.inc(effect=tag, reason=reason)
+        try:
+            with (trace.stage("fallback_upscale") if trace else contextlib.nullcontext()):
+                return await POOL.run(local_upscale, im, C["scale_factor"]), "local"
+        except JobCancelled:
+            return im, "cancelled"
+
+# ---------- WORKER POOL ----------
+class PoolBusy(Exception):
+    pass
+
+def _pool_worker_init():
+    # параллелим процессами — внутренние потоки OpenCV только толкались бы между воркерами
+    cv2.setNumThreads(1)
+
+class RenderPool:
+    """
+    Процессный пул для эффектов + ограниченная очередь с позицией (event loop не блокируется).
+    Воркеры раздаёт FairScheduler: по кругу между пользователями, ne2 (Job.fast) — раньше.
+    """
+    def __init__(self, workers: int, queue_max: int, per_user: int = 0):
+        self.workers   = max(1, workers)
+        self.queue_max = max(0, queue_max)
+        self.gate      = FairScheduler("pool", self.workers, per_user)
+        self._ex = None
+        self._pending = 0   # принятые задачи: в работе + в очереди
+        self.restarts = 0
+
+    def start(self):
+        if self._ex is not None and self.broken:
+            self._drop(self._ex)
+        if self._ex is None:
+            self._ex = ProcessPoolExecutor(max_workers=self.workers, initializer=_pool_worker_init)
+
+    @property
+    def broken(self) -> bool:
+        """Воркер умер (OOM-kill, падение в cv2/libjpeg) — такой executor больше задач не примет."""
+        return bool(self._ex is not None and getattr(self._ex, "_broken", False))
+
+    def _drop(self, ex):
+        # сломанный executor бросаем — следующий start() поднимет новый
+        if self._ex is ex:
+            logging.error("pool: worker process died, restarting the pool")
+            ex.shutdown(wait=False, cancel_futures=True)
+            self._ex = None
+            self.restarts += 1
+
+    def shutdown(self):
+        if self._ex is not None:
+            self._ex.shutdown(wait=False, cancel_futures=True)
+            self._ex = None
+
+    @contextlib.contextmanager
+    def admit(self):
+        """Резервирует место; отдаёт позицию в очереди (0 — сразу в работу). Полная очередь -> PoolBusy."""
+        if self._pending >= self.workers + self.queue_max:
+            raise PoolBusy()
+        pos = max(0, self._pending - self.workers + 1)
+        self._pending += 1
+        try:
+            yield pos
+        finally:
+            self._pending -= 1
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def queued(self) -> int:
+        return max(0, self._pending - self.workers)
+
+    async def run(self, fn, *args):
+        """BrokenProcessPool долетает только до задач, что были в умершем пуле; следующие идут в новый."""
+        async with self.gate.slot(CURRENT_JOB.get()):
+            self.start()
+            ex = self._ex
+            try:
+                return await asyncio.get_running_loop().run_in_executor(ex, fn, *args)
+            except BrokenProcessPool:
+                self._drop(ex)
+                raise
+
+POOL = RenderPool(POOL_WORKERS, POOL_QUEUE_MAX, USER_POOL_MAX)
+
+# ---------- RESULT CACHE ----------
+def _effect_config(effect: str) -> dict:
+    """Всё, от чего зависит картинка эффекта (кроме самого фото и ui_gain)."""
+    cfg = dict(v=CACHE_VERSION, input_max_side=INPUT_MAX_SIDE, limit=FINAL_TELEGRAM_LIMIT)
+    if effect == "wow":
+        cfg.update(color=(COLOR_VIBRANCE_BASE, COLOR_CONTRAST_BASE, COLOR_BRIGHT_BASE),
+                   depth=(DEPTH_S_CURVE_BASE, DEPTH_MICROCONTR_BASE, DEPTH_HP_RADIUS_BASE, DEPTH_UNSHARP_BASE),
+                   drama=(DRAMA_HDR_LOGA_BASE, DRAMA_BLOOM_AMOUNT, DRAMA_BLOOM_RADIUS),
+                   anti_grey=(ANTI_GREY_TOL, ANTI_GREY_CAP), clarity=CL_BASE)
+    elif effect in ("violin_boost", "violin_boost2"):
+        cfg.update(vibrance=VIOLIN_VIBRANCE, skin=(SKIN_MASK_SCALE, SKIN_MASK_FEATHER),
+                   clarity=CL_BASE if effect == "violin_boost" else CL_V2)
+    if "clarity" in cfg:
+        cfg["model"] = MODEL_CLARITY
+        cfg["clarity_input_max_side"] = CLARITY_INPUT_MAX_SIDE
+        # без токена WOW/Violin — чисто локальный рендер: включили Clarity — такие записи не должны находиться
+        cfg["clarity_on"] = bool(REPL_TOKEN)
+    return cfg
+
+def result_key(file_unique_id: str, effect: str, ui_gain: float) -> str:
+    raw = json.dumps([file_unique_id, effect, round(float(ui_gain), 4), _effect_config(effect)], sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+class ResultCache:
+    """
+    Готовые JPEG по ключу result_key: LRU в памяти + каталог на диске с потолком по размеру
+    (вытесняем самые давно использованные). Дисковые операции — в потоке, не на event loop.
+    """
+    def __init__(self, mem_max: int, disk_dir: str, disk_max: int):
+        self.mem_max  = mem_max
+        self.disk_dir = disk_dir or None
+        self.disk_max = disk_max
+        self._mem     = OrderedDict()
+        self._mem_bytes = 0
+        self._disk    = None            # key -> (size, last_used); читаем каталог лениво
+        self._disk_bytes = 0
+        self._lock    = threading.Lock()
+        self.stats    = dict(hits_mem=0, hits_disk=0, misses=0, puts=0, evictions=0)
+
+    def hit_rate(self) -> float:
+        hits = self.stats["hits_mem"] + self.stats["hits_disk"]
+        total = hits + self.stats["misses"]
+        return hits / total if total else 0.0
+
+    # --- память ---
+    def _mem_put(self, key: str, data: bytes):
+        if len(data) > self.mem_max:
+            return
+        old = self._mem.pop(key, None)
+        if old is not None: self._mem_bytes -= len(old)
+        self._mem[key] = data; self._mem_bytes += len(data)
+        while self._mem_bytes > self.mem_max:
+            _, ev = self._mem.popitem(last=False); self._mem_bytes -= len(ev)
+
+    # --- диск (вызывается из потока) ---
+    def _path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key[:2], key + ".jpg")
+
+    def _disk_index(self):
+        if self._disk is None:
+            self._disk, self._disk_bytes = {}, 0
+            for root, _, files in os.walk(self.disk_dir):
+                for fn in files:
+                    if not fn.endswith(".jpg"): continue
+                    st = os.stat(os.path.join(root, fn))
+                    self._disk[fn[:-4]] = (st.st_size, st.st_mtime)
+                    self._disk_bytes += st.st_size
+        return self._disk
+
+    def _disk_get(self, key: str):
+        with self._lock:
+            if key not in self._disk_index():
+                return None
+            path = self._path(key)
+            try:
+                with open(path, "rb") as f: data = f.read()
+                now = time.time(); os.utime(path, (now, now))
+                self._disk[key] = (len(data), now)
+                return data
+            except OSError:
+                size, _ = self._disk.pop(key); self._disk_bytes -= size
+                return None
+
+    def _disk_put(self, key: str, data: bytes):
+        with self._lock:
+            idx  = self._disk_index()
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = path + ".part"
+            with open(tmp, "wb") as f: f.write(data)
+            os.replace(tmp, path)
+            if key in idx: self._disk_bytes -= idx[key][0]
+            idx[key] = (len(data), time.time()); self._disk_bytes += len(data)
+            if self._disk_bytes > self.disk_max:
+                for k, (size, _) in sorted(idx.items(), key=lambda kv: kv[1][1]):
+                    if self._disk_bytes <= self.disk_max * 0.9: break
+                    try: os.remove(self._path(k))
+                    except OSError: pass
+                    del idx[k]; self._disk_bytes -= size
+                    self.stats["evictions"] += 1
+
+    # --- API ---
+    async def get(self, key: str):
+        data = self._mem.get(key)
+        if data is not None:
+            self._mem.move_to_end(key)
+            self.stats["hits_mem"] += 1
+            return data
+        if self.disk_dir:
+            data = await asyncio.to_thread(self._disk_get, key)
+            if data is not None:
+                self._mem_put(key, data)
+                self.stats["hits_disk"] += 1
+                return data
+        self.stats["misses"] += 1
+        return None
+
+    async def put(self, key: str, data: bytes):
+        self.stats["puts"] += 1
+        self._mem_put(key, data)
+        if self.disk_dir:
+            try:
+                await asyncio.to_thread(self._disk_put, key, data)
+            except OSError as e:
+                logging.warning("result cache: disk write failed: %s", e)
+
+RESULT_CACHE = ResultCache(CACHE_MEM_MAX_MB << 20, CACHE_DIR, CACHE_DISK_MAX_MB << 20)
 
 # ---------- UI ----------
 KB_MAIN = ReplyKeyboardMarkup(
@@ -391,90 +1641,421 @@ async def on_start(m: types.Message):
         reply_markup=KB_MAIN
     )
 
+@dp.message_handler(commands=["cancel"])
+async def on_cancel(m: types.Message):
+    """Снимает фото пользователя, ждущие воркера или Clarity (то, что уже считается, доедет)."""
+    n = POOL.gate.cancel(m.from_user.id) + CLARITY.gate.cancel(m.from_user.id)
+    await m.answer(f"✋ Снял из очереди: {n}." if n else "В очереди ничего нет.", reply_markup=KB_MAIN)
+
 @dp.message_handler(lambda m: m.text in ["🌿 Nature Enhance 2.0 (HDR)", "🌿 WOW Enhance (в разработке)", "🎻 Violin Touch", "Усиление 🎻", "Усиление 2 🎻"])
 async def on_mode(m: types.Message):
     uid = m.from_user.id
     txt = m.text
     if txt == "🌿 WOW Enhance (в разработке)":
-        WAIT[uid] = {"effect": "wow_menu"}
+        await SESSIONS.set(uid, {"effect": "wow_menu"})
         await m.answer("Выбери силу эффекта:", reply_markup=KB_STRENGTH)
     elif txt == "🎻 Violin Touch":
-        WAIT[uid] = {"effect": "violin_menu"}
+        await SESSIONS.set(uid, {"effect": "violin_menu"})
         await m.answer("Выбери вариант 🎻:", reply_markup=KB_VIOLIN)
     elif txt == "Усиление 🎻":
-        WAIT[uid] = {"effect": "violin_boost"}
+        await SESSIONS.set(uid, {"effect": "violin_boost"})
         await m.answer("Пришли фото — сделаю 🎻 Violin Усиление", reply_markup=KB_MAIN)
     elif txt == "Усиление 2 🎻":
-        WAIT[uid] = {"effect": "violin_boost2"}
+        await SESSIONS.set(uid, {"effect": "violin_boost2"})
         await m.answer("Пришли фото — сделаю 🎻 Violin Усиление 2", reply_markup=KB_MAIN)
     else:
-        WAIT[uid] = {"effect": "ne2"}
+        await SESSIONS.set(uid, {"effect": "ne2"})
         await m.answer("Пришли фото — сделаю Nature Enhance 2.0 🌿", reply_markup=KB_MAIN)
 
 @dp.message_handler(lambda m: m.text in ["Низкая","Средняя","Высокая","⬅️ Назад"])
 async def on_strength(m: types.Message):
     uid = m.from_user.id
-    st  = WAIT.get(uid)
+    st  = await SESSIONS.get(uid)
     if not st: return
     if m.text == "⬅️ Назад":
-        WAIT.pop(uid, None); await m.answer("Главное меню.", reply_markup=KB_MAIN); return
+        await SESSIONS.pop(uid); await m.answer("Главное меню.", reply_markup=KB_MAIN); return
     if st.get("effect") != "wow_menu":
         return
     ui_gain = UI_MED
     if m.text == "Низкая":  ui_gain = UI_LOW
     if m.text == "Высокая": ui_gain = UI_HIGH
-    WAIT[uid] = {"effect": "wow", "ui_gain": float(ui_gain)}
+    await SESSIONS.set(uid, {"effect": "wow", "ui_gain": float(ui_gain)})
     await m.answer("Пришли фото — сделаю WOW Enhance 🌿", reply_markup=KB_MAIN)
 
+PHOTO_EFFECTS = ("ne2", "wow", "violin_boost", "violin_boost2")
+
 @dp.message_handler(content_types=["photo"])
 async def on_photo(m: types.Message):
+    if m.media_group_id:
+        return await collect_album(m)
     uid = m.from_user.id
-    st  = WAIT.get(uid)
-    if not st or st.get("effect") not in ["ne2", "wow", "violin_boost", "violin_boost2"]:
+    # режим забираем сразу: пока фото считается (Clarity — минуты), пользователь может выбрать следующий
+    st  = await SESSIONS.pop(uid)
+    if not st or st.get("effect") not in PHOTO_EFFECTS:
+        if st: await SESSIONS.set(uid, st)   # открытое подменю не трогаем
         await m.reply("Сначала выбери режим ⬇️", reply_markup=KB_MAIN); return
 
-    await m.reply("⏳ Обрабатываю...")
+    photo = pick_photo(m.photo, INPUT_MAX_SIDE)
+    eff   = st["effect"]
+    gain  = float(st.get("ui_gain", UI_MED))
+    key   = result_key(photo.file_unique_id, eff, gain)
+    trace = Trace(eff, gain)
+    outcome = "error"
+    job_ctx = CURRENT_JOB.set(Job(uid, fast=eff not in CLARITY_CFG))
     try:
-        local = await download_tg_photo(m.photo[-1].file_id)
-
-        eff = st["effect"]
-        if eff == "ne2":
-            out = hdr_only_path(local)
+        cached = await RESULT_CACHE.get(key)
+        if cached is not None:
+            logging.info("result cache hit %s (hit rate %.0f%%)", eff, 100*RESULT_CACHE.hit_rate())
+            with trace.stage("upload"):
+                await m.reply_photo(_jpeg_file(cached))
+            outcome = "cached"
+            return
+        with contextlib.ExitStack() as admitted:
+            # сначала место в очереди: отказ PoolBusy не должен тратить лимит частоты
+            pos  = admitted.enter_context(POOL.admit())
+            wait = LIMITER.allow(uid)
+            if wait:
+                # режим возвращаем — то же фото можно прислать ещё раз, когда лимит отпустит
+                outcome = "rate_limited"
+                await SESSIONS.set(uid, st)
+                await m.reply(f"🐢 Слишком много фото подряд — пришли это через {int(wait) + 1} с.")
+                return
+            if pos:
+                await m.reply(f"⏳ В очереди: {pos}. Обработаю, как освободится место. /cancel — отменить.")
+            else:
+                await m.reply("⏳ Обрабатываю...")
+            outcome = await process_photo(m, st, photo.file_id, key, trace, admitted)
+    except PoolBusy:
+        outcome = "busy"
+        await SESSIONS.set(uid, st)   # как и при лимите частоты: режим остаётся для повторной попытки
+        await m.reply("🚦 Сейчас очень много фото в работе — пришли это через минуту.", reply_markup=KB_MAIN)
+    except JobCancelled:
+        outcome = "cancelled"
+        await m.reply("✋ Отменено.", reply_markup=KB_MAIN)
+    except Exception:
+        # трейсбек — только в лог: в тексте исключений бывают URL с токеном бота
+        logging.exception("photo %s failed", eff)
+        await m.reply("🔥 Ошибка Nature Inspire — не получилось обработать фото, попробуй ещё раз.", reply_markup=KB_MAIN)
+    finally:
+        CURRENT_JOB.reset(job_ctx)
+        if outcome in ("rate_limited", "cancelled", "busy"):
+            JOBS_DROPPED.inc(reason=outcome)
+        trace.finish(outcome)
+
+async def _encode(eff: str, im: Image.Image, trace: Trace = None) -> bytes:
+    with (trace.stage("encode") if trace else contextlib.nullcontext()):
+        out, q, encodes = await POOL.run(ensure_size_under_telegram_limit, im)
+    logging.info("encode %s: %dx%d -> %d KB (q%d, %d encodes)", eff, im.size[0], im.size[1], len(out) >> 10, q, encodes)
+    return out
+
+def _jpeg_file(data: bytes) -> InputFile:
+    return InputFile(io.BytesIO(data), filename="nature_inspire.jpg")
+
+async def render_photo(file_id: str, eff: str, ui_gain: float, trace: Trace) -> Image.Image:
+    with trace.stage("download"):
+        data = await download_tg_photo(file_id)
+    t = time.monotonic()
+    im, took = await POOL.run(render_local, data, eff, ui_gain)
+    for stage, sec in took.items():
+        trace.add(stage, sec)
+    # всё, что сверх работы воркера, — ожидание свободного воркера + пересылка картинки между процессами
+    trace.add("pool_wait", max(0.0, time.monotonic() - t - sum(took.values())))
+    return im
+
+async def _swap(m: types.Message, preview: types.Message, out: bytes, eff: str, captioned: bool = True) -> bool:
+    """
+    Превью -> финал на месте; не вышло (старое сообщение и т.п.) — отдельным фото, а с превью (если на нём
+    подпись «заменю это фото») снимаем подпись. -> True, если подменили на месте.
+    """
+    try:
+        await preview.edit_media(types.InputMediaPhoto(_jpeg_file(out)))
+        return True
+    except TelegramAPIError as e:
+        logging.warning("preview %s: edit_media failed (%s), sending separately", eff, e)
+    if captioned:
+        with contextlib.suppress(TelegramAPIError):
+            await preview.edit_caption("")
+    await m.reply_photo(_jpeg_file(out))
+    return False
+
+async def process_photo(m: types.Message, st: dict, file_id: str, key: str, trace: Trace,
+                        admitted: contextlib.ExitStack) -> str:
+    """
+    -> исход для метрик: local | clarity | fallback (локальный апскейл) | preview (Clarity отменили).
+    admitted — место в очереди пула: держим только на CPU-стадиях, с превью отдаём (Clarity ждёт без него).
+    """
+    eff = st["effect"]
+    im  = await render_photo(file_id, eff, float(st.get("ui_gain", UI_MED)), trace)
+
+    cfg = CLARITY_CFG.get(eff)
+    if cfg is None or not REPL_TOKEN:
+        out = await _encode(eff, im, trace)
+        with trace.stage("upload"):
+            await m.reply_photo(_jpeg_file(out))
+        await RESULT_CACHE.put(key, out)
+        return "local"
+
+    # Локальный рендер готов за секунду — сразу отдаём его превью, Clarity догоняет и подменяет фото
+    out = await _encode(eff, im, trace)
+    with trace.stage("preview_upload"):
+        preview = await m.reply_photo(_jpeg_file(out), caption=PREVIEW_CAPTION)
+    admitted.close()
+    final, via = await clarity_post(im, cfg=cfg, tag=eff, trace=trace)
+    try:
+        if via == "cancelled":
+            raise JobCancelled()
+        out = await _encode(eff, final, trace)
+    except JobCancelled:
+        # сняли из очереди (Clarity или финальный энкод) — превью и есть результат
+        with contextlib.suppress(TelegramAPIError):
+            await preview.edit_caption("")
+        return "preview"
+    with trace.stage("upload"):
+        await _swap(m, preview, out, eff)
+    if via != "clarity":
+        return "fallback"   # локальный апскейл не кэшируем: в другой раз Clarity может успеть
+    await RESULT_CACHE.put(key, out)
+    return "clarity"
+
+# ---------- ALBUMS ----------
+ALBUMS = {}   # (chat_id, media_group_id) -> сообщения альбома, пока он собирается
+
+async def collect_album(m: types.Message):
+    """
+    Telegram шлёт альбом отдельными сообщениями с общим media_group_id. Первое сообщение собирает
+    остальные, пока они идут (ALBUM_WAIT_S тишины), и обрабатывает альбом целиком; остальные просто
+    докладываются в пачку.
+    """
+    key   = (m.chat.id, m.media_group_id)
+    batch = ALBUMS.get(key)
+    if batch is not None:
+        batch.append(m); return
+    ALBUMS[key] = batch = [m]
+    try:
+        seen = 0
+        while seen != len(batch):
+            seen = len(batch)
+            await asyncio.sleep(ALBUM_WAIT_S)
+    finally:
+        del ALBUMS[key]
+    await on_album(sorted(batch, key=lambda x: x.message_id))
 
-        elif eff == "violin_boost":
-            tmp = violin_touch_v1_path(local)
-            out = clarity_post_path(tmp, cfg=CL_BASE)  # Clarity v1
-            try:
-                if tmp != out and os.path.exists(tmp): os.remove(tmp)
-            except: pass
+async def _send_group(m: types.Message, outs: list, caption: str = None) -> list:
+    """Готовые JPEG одним альбомом (1 фото — обычным фото); Telegram отказал — по одному."""
+    if len(outs) == 1:
+        return [await m.reply_photo(_jpeg_file(outs[0]), caption=caption)]
+    try:
+        return await m.reply_media_group([types.InputMediaPhoto(_jpeg_file(o), caption=caption if i == 0 else None)
+                                          for i, o in enumerate(outs)])
+    except TelegramAPIError as e:
+        logging.warning("album: send_media_group failed (%s), sending one by one", e)
+        return [await m.reply_photo(_jpeg_file(o), caption=caption if i == 0 else None) for i, o in enumerate(outs)]
+
+async def on_album(msgs: list):
+    """Альбом — один выбор режима на все фото; ответ — тоже одним альбомом в том же порядке."""
+    m   = msgs[0]
+    uid = m.from_user.id
+    st  = await SESSIONS.pop(uid)   # как в on_photo: режим забран, новый выбор во время обработки не теряется
+    if not st or st.get("effect") not in PHOTO_EFFECTS:
+        if st: await SESSIONS.set(uid, st)
+        await m.reply("Сначала выбери режим ⬇️", reply_markup=KB_MAIN); return
 
-        elif eff == "violin_boost2":
-            tmp = violin_touch_v2_path(local)          # чуть сочнее ДО clarity
-            out = clarity_post_path(tmp, cfg=CL_V2)    # Clarity v2 (чуть сильнее)
-            try:
-                if tmp != out and os.path.exists(tmp): os.remove(tmp)
-            except: pass
+    eff   = st["effect"]
+    gain  = float(st.get("ui_gain", UI_MED))
+    photos = [pick_photo(x.photo, INPUT_MAX_SIDE) for x in msgs]
+    shots  = [dict(photo=p, key=result_key(p.file_unique_id, eff, gain), trace=Trace(eff, gain), out=None, outcome="error")
+              for p in photos]
+    job_ctx = CURRENT_JOB.set(Job(uid, fast=eff not in CLARITY_CFG))
+    try:
+        for sh in shots:
+            sh["out"] = await RESULT_CACHE.get(sh["key"])
+            if sh["out"] is not None:
+                sh["outcome"] = "cached"
+        todo = [sh for sh in shots if sh["out"] is None]
+        if not todo:
+            await _send_group(m, [sh["out"] for sh in shots])
+            return
+        with contextlib.ExitStack() as admitted:
+            pos  = [admitted.enter_context(POOL.admit()) for _ in todo][0]
+            wait = LIMITER.allow(uid, len(todo))
+            if wait:
+                for sh in todo: sh["outcome"] = "rate_limited"
+                await SESSIONS.set(uid, st)
+                await m.reply(f"🐢 Слишком много фото подряд — пришли альбом через {int(wait) + 1} с.")
+                return
+            if pos:
+                await m.reply(f"⏳ Альбом ({len(todo)} фото) в очереди: {pos}. /cancel — отменить.")
+            else:
+                await m.reply(f"⏳ Обрабатываю альбом ({len(todo)} фото)...")
+            await process_album(m, st, shots, todo, admitted)
+    except PoolBusy:
+        for sh in todo: sh["outcome"] = "busy"
+        await SESSIONS.set(uid, st)
+        await m.reply("🚦 Сейчас очень много фото в работе — пришли альбом через минуту.", reply_markup=KB_MAIN)
+    except JobCancelled:
+        for sh in todo:
+            if sh["outcome"] == "error": sh["outcome"] = "cancelled"
+        await m.reply("✋ Отменено.", reply_markup=KB_MAIN)
+    except Exception:
+        logging.exception("album %s failed", eff)
+        await m.reply("🔥 Ошибка Nature Inspire — не получилось обработать альбом, попробуй ещё раз.", reply_markup=KB_MAIN)
+    finally:
+        CURRENT_JOB.reset(job_ctx)
+        for sh in shots:
+            if sh["outcome"] in ("rate_limited", "cancelled", "busy"):
+                JOBS_DROPPED.inc(reason=sh["outcome"])
+            sh["trace"].finish(sh["outcome"])
 
-        else:  # wow
-            tmp = wow_enhance_path(local, ui_gain=float(st.get("ui_gain", UI_MED)))
-            out = clarity_post_path(tmp, cfg=CL_BASE)  # WOW на базовом clarity
-            try:
-                if tmp != out and os.path.exists(tmp): os.remove(tmp)
-            except: pass
+async def process_album(m: types.Message, st: dict, shots: list, todo: list, admitted: contextlib.ExitStack):
+    """
+    Локальные рендеры — параллельно по воркерам пула, превью — одним альбомом, Clarity — веером
+    (в пределах лимитов планировщика); каждое фото подменяется на месте, как только готов его Clarity.
+    admitted — места альбома в очереди пула: как в process_photo, отдаём их вместе с превью.
+    """
+    eff  = st["effect"]
+    gain = float(st.get("ui_gain", UI_MED))
+    ims  = await asyncio.gather(*(render_photo(sh["photo"].file_id, eff, gain, sh["trace"]) for sh in todo),
+                                return_exceptions=True)
+    done, failed = [], 0
+    for sh, im in zip(todo, ims):
+        if isinstance(im, JobCancelled):
+            sh["outcome"] = "cancelled"
+        elif isinstance(im, BaseException):
+            logging.error("album %s: render failed", eff, exc_info=im)
+            failed += 1
+        else:
+            sh["im"] = im; done.append(sh)
+    outs = await asyncio.gather(*(_encode(eff, sh["im"], sh["trace"]) for sh in done))
+    for sh, out in zip(done, outs):
+        sh["out"] = out
+
+    ready = [sh for sh in shots if sh["out"] is not None]   # порядок альбома, вместе с кэшем
+    if not ready:
+        await m.reply("✋ Отменено." if any(sh["outcome"] == "cancelled" for sh in todo) else "🔥 Не получилось обработать альбом.")
+        return
+    if failed:
+        await m.reply(f"⚠️ Не получилось обработать фото: {failed} из {len(shots)}.")
+
+    cfg = CLARITY_CFG.get(eff)
+    t   = time.monotonic()
+    sent = await _send_group(m, [sh["out"] for sh in ready], caption=PREVIEW_CAPTION if cfg and REPL_TOKEN else None)
+    for sh in done:
+        sh["trace"].add("preview_upload" if cfg and REPL_TOKEN else "upload", time.monotonic() - t)
+    admitted.close()
+    if cfg is None or not REPL_TOKEN:
+        for sh in done:
+            await RESULT_CACHE.put(sh["key"], sh["out"]); sh["outcome"] = "local"
+        return
 
-        safe = ensure_size_under_telegram_limit(out)
-        await m.reply_photo(InputFile(safe))
+    async def finish(sh: dict, preview: types.Message):
+        final, via = await clarity_post(sh["im"], cfg=cfg, tag=eff, trace=sh["trace"])
         try:
-            for p in [local, out]:
-                if os.path.exists(p): os.remove(p)
-            if safe != out and os.path.exists(safe): os.remove(safe)
-        except: pass
-    except Exception:
-        tb = traceback.format_exc(limit=20)
-        await m.reply(f"🔥 Ошибка Nature Inspire:\n```\n{tb}\n```", parse_mode="Markdown")
+            if via == "cancelled":
+                raise JobCancelled()
+            out = await _encode(eff, final, sh["trace"])
+        except JobCancelled:
+            sh["outcome"] = "preview"; return   # подпись первого фото снимет код ниже
+        with sh["trace"].stage("upload"):
+            # подпись «Превью…» в альбоме только у первого фото; если подмена не вышла, _swap снимет её сам
+            sh["swapped"] = await _swap(m, preview, out, eff, captioned=preview is sent[0])
+        if via != "clarity":
+            sh["outcome"] = "fallback"; return
+        await RESULT_CACHE.put(sh["key"], out)
+        sh["outcome"] = "clarity"
+
+    await asyncio.gather(*(finish(sh, msg) for sh, msg in zip(ready, sent) if "im" in sh))
+    if "swapped" not in ready[0]:
+        # подпись «Превью…» висит на первом фото; после _swap её уже нет (подменили или сняли), иначе — снимаем сами
+        with contextlib.suppress(TelegramAPIError):
+            await sent[0].edit_caption("")
+
+# ---------- WEBHOOK ----------
+UPDATE_TASKS = set()   # апдейты из webhook в работе (держим ссылки, чтобы задачи не собрал GC)
+
+async def on_webhook(request: web.Request) -> web.Response:
+    """
+    Telegram -> POST WEBHOOK_PATH. Проверяем секрет и сразу отвечаем 200, обработка — отдельной задачей:
+    Telegram не ждёт рендер и не шлёт апдейт повторно, пока мы работаем.
+    """
+    got = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(got.encode(), WEBHOOK_SECRET.encode()):
+        WEBHOOK_UPDATES.inc(result="forbidden")
+        return web.Response(status=403)
+    try:
+        update = types.Update(**(await request.json()))
+    except (ValueError, TypeError):
+        WEBHOOK_UPDATES.inc(result="bad_request")
+        return web.Response(status=400)
+    WEBHOOK_UPDATES.inc(result="accepted")
+    # хендлеры aiogram берут bot/dp из контекста — задача наследует его копию
+    Bot.set_current(bot); Dispatcher.set_current(dp)
+    task = asyncio.create_task(dp.process_update(update))
+    UPDATE_TASKS.add(task)
+    task.add_done_callback(_update_done)
+    return web.Response()
+
+def _update_done(task: asyncio.Task):
+    UPDATE_TASKS.discard(task)
+    if not task.cancelled() and task.exception():
+        logging.error("webhook update failed", exc_info=task.exception())
+
+async def drain_updates(timeout: float):
+    if not UPDATE_TASKS:
+        return
+    logging.info("webhook: waiting for %d update(s)", len(UPDATE_TASKS))
+    _, pending = await asyncio.wait(set(UPDATE_TASKS), timeout=timeout)
+    for t in pending:
+        t.cancel()
+
+async def run_webhook():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await on_startup(None, webhook=True)
+    try:
+        # drop_pending_updates не ставим: апдейты, пришедшие во время рестарта, Telegram доставит повторно
+        await bot.set_webhook(WEBHOOK_URL + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                              allowed_updates=["message"])
+        logging.info("webhook: %s%s", WEBHOOK_URL, WEBHOOK_PATH)
+        await stop.wait()
     finally:
-        WAIT.pop(uid, None)
+        # webhook не снимаем: при нескольких репликах остальные продолжают принимать апдейты
+        await stop_web()              # новые апдейты больше не принимаем...
+        await drain_updates(WEBHOOK_DRAIN_S)   # ...а начатые доводим до конца
+        await on_shutdown(None)
+        await (await bot.get_session()).close()
+
+# ---------- HTTP / ЗАПУСК ----------
+WEB = {"runner": None}
+
+async def start_web(app: web.Application):
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", HTTP_PORT).start()
+    WEB["runner"] = runner
+    logging.info("http: /metrics on :%d", HTTP_PORT)
+
+async def stop_web():
+    runner, WEB["runner"] = WEB["runner"], None
+    if runner:
+        await runner.cleanup()
+
+async def on_startup(_, webhook: bool = False):
+    POOL.start()   # форкаем воркеров заранее, пока нет лишних потоков
+    await start_web(make_web_app(webhook))
+
+async def on_shutdown(_):
+    await stop_web()
+    await CLARITY.drain()
+    POOL.shutdown()
+    SESSIONS.close()
 
 if __name__ == "__main__":
-    print(">> Starting polling…")
-    executor.start_polling(dp, skip_updates=True)
+    if WEBHOOK_URL:
+        print(">> Starting webhook…")
+        asyncio.run(run_webhook())
+    else:
+        # локальная разработка: long polling (webhook, если был, aiogram снимает сам)
+        print(">> Starting polling…")
+        executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
@@ -0,0 +1,9 @@
+import os, sys
+
+# bot.py читает окружение при импорте: токены-заглушки, без дискового кэша и без сети наружу
+os.environ.setdefault("TELEGRAM_API_TOKEN", "123:test")
+os.environ.setdefault("REPLICATE_API_TOKEN", "test")
+os.environ["CACHE_DIR"] = ""
+os.environ.pop("SESSION_DB", None)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,221 @@
+# ClarityClient против локального фейка Replicate (aiohttp в том же процессе)
+import asyncio, itertools
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import bot
+
+
+class FakeReplicate:
+    """
+    /v1/predictions как у Replicate. mode: ok | failed | slow (вечно processing).
+    Пишет созданные/отменённые prediction'ы и максимум одновременно незавершённых.
+    """
+    def __init__(self, mode: str = "ok", polls: int = 2):
+        self.mode, self.polls = mode, polls
+        self.preds, self.cancelled = {}, []
+        self.active = self.max_active = 0
+        self.ids = itertools.count()
+        app = web.Application()
+        app.router.add_post("/v1/predictions", self.create)
+        app.router.add_get("/v1/predictions/{id}", self.get)
+        app.router.add_post("/v1/predictions/{id}/cancel", self.cancel)
+        self.server = TestServer(app)
+
+    @property
+    def base(self) -> str:
+        return str(self.server.make_url("")).rstrip("/")
+
+    def _body(self, pid: str, status: str, **kw) -> dict:
+        urls = {"get": f"{self.base}/v1/predictions/{pid}", "cancel": f"{self.base}/v1/predictions/{pid}/cancel"}
+        return {"id": pid, "status": status, "urls": urls, **kw}
+
+    def _finish(self, pid: str):
+        if not self.preds[pid]["done"]:
+            self.preds[pid]["done"] = True
+            self.active -= 1
+
+    async def create(self, request):
+        body = await request.json()
+        pid  = str(next(self.ids))
+        self.preds[pid] = dict(input=body["input"], version=body["version"], polls=0, done=False)
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        return web.json_response(self._body(pid, "starting"), status=201)
+
+    async def get(self, request):
+        pid  = request.match_info["id"]
+        pred = self.preds[pid]
+        pred["polls"] += 1
+        if self.mode == "slow" or pred["polls"] < self.polls:
+            return web.json_response(self._body(pid, "processing"))
+        self._finish(pid)
+        if self.mode == "failed":
+            return web.json_response(self._body(pid, "failed", error="boom"))
+        return web.json_response(self._body(pid, "succeeded", output=[f"{self.base}/out/{pid}.png"]))
+
+    async def cancel(self, request):
+        pid = request.match_info["id"]
+        self.cancelled.append(pid)
+        self._finish(pid)
+        return web.json_response(self._body(pid, "canceled"))
+
+
+@pytest.fixture(autouse=True)
+def fast_polls(monkeypatch):
+    monkeypatch.setattr(bot, "CLARITY_POLL_MIN_S", 0.01)
+    monkeypatch.setattr(bot, "CLARITY_POLL_MAX_S", 0.02)
+    monkeypatch.setattr(bot, "CLARITY_MIN_RUN_S", 0.0)
+
+
+def run(coro_fn, mode: str = "ok", **client_kw):
+    """coro_fn(fake, client) в свежем loop'е: фейк поднят, сессия бота закрыта в конце."""
+    async def main():
+        fake = FakeReplicate(mode)
+        await fake.server.start_server()
+        kw = dict(max_inflight=4, deadline_s=10.0)
+        kw.update(client_kw)
+        client = bot.ClarityClient(fake.base, "test", **kw)
+        try:
+            return await coro_fn(fake, client)
+        finally:
+            await (await bot.bot.get_session()).close()
+            await fake.server.close()
+    return asyncio.run(main())
+
+
+def test_success_returns_output():
+    async def go(fake, client):
+        out = await client.run(bot.MODEL_CLARITY, {"image": "x"}, tag="wow")
+        assert out == [f"{fake.base}/out/0.png"]
+        assert fake.preds["0"]["version"] == bot.MODEL_CLARITY.split(":", 1)[-1]
+        assert fake.preds["0"]["input"] == {"image": "x"}
+        assert client.inflight == 0
+        (job,) = client.jobs
+        assert job["tag"] == "wow" and job["outcome"] == "ok"
+        assert job["wait_s"] >= 0 and job["run_s"] > 0
+    run(go)
+
+
+def test_failed_prediction_raises():
+    async def go(fake, client):
+        with pytest.raises(bot.ClarityError, match="boom"):
+            await client.run(bot.MODEL_CLARITY, {}, tag="violin_boost")
+        assert client.jobs[-1]["outcome"] == "failed"
+        assert fake.cancelled == []   # завершённый prediction не отменяем
+    run(go, mode="failed")
+
+
+def test_timeout_cancels_prediction():
+    async def go(fake, client):
+        with pytest.raises(asyncio.TimeoutError):
+            await client.run(bot.MODEL_CLARITY, {}, tag="wow")
+        assert len(client.cancels) == 1   # отмена уходит фоном, ссылка на задачу хранится
+        await client.drain()
+        assert fake.cancelled == ["0"] and not client.cancels
+        job = client.jobs[-1]
+        assert job["outcome"] == "timeout" and 0.3 <= job["run_s"] < 2.0
+        assert client.inflight == 0
+    run(go, mode="slow", deadline_s=0.4)
+
+
+def test_inflight_cap_and_queue_wait():
+    async def go(fake, client):
+        async def one(uid):
+            bot.CURRENT_JOB.set(bot.Job(uid))
+            return await client.run(bot.MODEL_CLARITY, {}, tag="wow")
+        fake.polls = 5
+        outs = await asyncio.gather(*(one(uid) for uid in range(6)))
+        assert len(outs) == 6 and fake.max_active == 2
+        assert len(client.jobs) == 6 and all(j["outcome"] == "ok" for j in client.jobs)
+        waited = sorted(j["wait_s"] for j in client.jobs)
+        assert waited[0] < 0.05 and waited[-1] > 0.05   # последние ждали слота
+    run(go, max_inflight=2)
+
+
+def test_cancelled_task_cancels_prediction():
+    async def go(fake, client):
+        task = asyncio.ensure_future(client.run(bot.MODEL_CLARITY, {}, tag="wow"))
+        await asyncio.sleep(0.1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await client.drain()
+        assert fake.cancelled == ["0"]
+        assert client.jobs[-1]["outcome"] == "cancelled"
+    run(go, mode="slow")
+
+
+# ---------- предохранитель и локальный апскейл ----------
+def test_breaker_opens_and_skips_replicate():
+    async def go(fake, client):
+        client.breaker = bot.CircuitBreaker("clarity", 2, 60.0, 600.0)
+        for _ in range(2):
+            with pytest.raises(bot.ClarityError):
+                await client.run(bot.MODEL_CLARITY, {}, tag="wow")
+        assert client.breaker.state == "open" and client.breaker.is_open()
+        with pytest.raises(bot.ClarityUnavailable) as e:
+            await client.run(bot.MODEL_CLARITY, {}, tag="wow")
+        assert e.value.reason == "breaker_open"
+        assert len(fake.preds) == 2                      # третий вызов до Replicate не дошёл
+        assert [j["outcome"] for j in client.jobs] == ["failed", "failed", "breaker_open"]
+    run(go, mode="failed")
+
+
+def test_breaker_probe_recovers_and_failed_probe_backs_off():
+    async def go(fake, client):
+        client.breaker = br = bot.CircuitBreaker("clarity", 1, 0.2, 0.3)
+        with pytest.raises(bot.ClarityError):
+            await client.run(bot.MODEL_CLARITY, {}, tag="wow")
+        assert br.state == "open" and br.trips == 1
+        await asyncio.sleep(0.25)
+        with pytest.raises(bot.ClarityError):            # проба упала — пауза удвоилась (но не выше максимума)
+            await client.run(bot.MODEL_CLARITY, {}, tag="wow")
+        assert br.state == "open" and br.cooldown == 0.3 and br.trips == 2
+        fake.mode = "ok"
+        await asyncio.sleep(0.35)
+        assert not br.is_open()
+        await client.run(bot.MODEL_CLARITY, {}, tag="wow")   # проба удалась
+        assert br.state == "closed" and br.cooldown == 0.2 and br.fails == 0
+    run(go, mode="failed")
+
+
+def test_only_one_probe_at_a_time():
+    br = bot.CircuitBreaker("t", 1, 0.0, 0.0)
+    br.failure()
+    assert br.allow() and br.state == "half_open"
+    assert not br.allow() and br.is_open()               # вторая проба ждёт исхода первой
+    br.release_probe()                                   # первую отменили — можно пробовать снова
+    assert br.allow()
+
+
+def test_budget_spent_in_queue_skips_without_tripping(monkeypatch):
+    monkeypatch.setattr(bot, "CLARITY_MIN_RUN_S", 0.8)
+    async def go(fake, client):
+        client.breaker = bot.CircuitBreaker("clarity", 1, 60.0, 600.0)
+        async def one(uid):
+            bot.CURRENT_JOB.set(bot.Job(uid))
+            return await client.run(bot.MODEL_CLARITY, {}, tag="wow", budget_s=1.0)
+        fake.polls = 15                                  # первый держит единственный слот ~0.3 с
+        first, second = await asyncio.gather(one(1), one(2), return_exceptions=True)
+        assert first == [f"{fake.base}/out/0.png"]
+        assert isinstance(second, bot.ClarityUnavailable) and second.reason == "budget"
+        assert len(fake.preds) == 1 and client.breaker.state == "closed"
+    run(go, max_inflight=1)
+
+
+def test_clarity_post_falls_back_to_local_upscale(monkeypatch):
+    monkeypatch.setattr(bot, "REPL_TOKEN", "test")
+    async def go(fake, client):
+        monkeypatch.setattr(bot, "CLARITY", client)
+        try:
+            im = bot.Image.new("RGB", (2000, 1500), (120, 90, 60))
+            out, via = await bot.clarity_post(im, cfg=bot.CL_BASE, tag="wow")
+            assert via == "local" and fake.preds
+            side = bot.CLARITY_INPUT_MAX_SIDE                 # размер как у Clarity: вход ужат и x scale_factor
+            assert out.size == (2 * side, round(2 * 1500 * side / 2000))
+        finally:
+            bot.POOL.shutdown()
+    run(go, mode="failed")